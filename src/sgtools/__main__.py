@@ -0,0 +1,242 @@
+#!/usr/bin/env python3 --
+# vim: set sts=4 sw=4 et :
+
+"""One command for all of the tools, as "python -m sgtools SUBCOMMAND ...".
+
+Each subcommand runs the main() of its module, which is only imported when it's used.
+"""
+
+try:
+    from typing import TYPE_CHECKING
+except ImportError:
+    TYPE_CHECKING = False
+else:
+    from typing import Dict
+    from typing import IO
+    from typing import List
+    from typing import Optional
+    from typing import Tuple
+
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stdout
+import importlib
+import shlex
+import sys
+import threading
+import traceback
+
+
+class Subcommand:
+    """Where a subcommand lives, and whether batch mode can share out its inputs.
+
+    Every subcommand's arguments are leading options, then fixed_args arguments that aren't inputs,
+    such as the archive to write, then anything else.
+    Only batchable ones take any number of inputs there, each handled on its own,
+    and have a run(args) function like main() that takes its arguments directly.
+    Their batch_excludes are options that don't work when the inputs are split between processes.
+    """
+    __slots__ = (
+        "module_name",
+        "fixed_args",
+        "batchable",
+        "batch_excludes",
+    )
+
+    def __init__(self, module_name, *, fixed_args=0, batchable=False, batch_excludes=()): # type: (str, *, int, bool, Tuple[str, ...]) -> None
+        self.module_name = module_name # type: str
+        self.fixed_args = fixed_args # type: int
+        self.batchable = batchable # type: bool
+        self.batch_excludes = batch_excludes # type: Tuple[str, ...]
+
+
+SUBCOMMANDS = {
+    # The dedup store's counts and manifest are per process.
+    "bpa": Subcommand("sgtools.game.deathrally.bpa", batchable=True, batch_excludes=("--dedup",)),
+    "bpapack": Subcommand("sgtools.game.deathrally.bpapack", fixed_args=1),
+    "bpapatch": Subcommand("sgtools.game.deathrally.bpapatch", fixed_args=1),
+    "bpk": Subcommand("sgtools.game.deathrally.bpk", batchable=True),
+    "bpkpack": Subcommand("sgtools.game.deathrally.bpkpack", fixed_args=2),
+    "catalog": Subcommand("sgtools.game.deathrally.catalog", fixed_args=2),
+    "cmf": Subcommand("sgtools.game.deathrally.cmf", batchable=True),
+    "gamedata": Subcommand("sgtools.game.deathrally.core"),
+    "haf": Subcommand("sgtools.game.deathrally.haf", fixed_args=3),
+    "haf2gif": Subcommand("sgtools.game.deathrally.haf2gif", batchable=True),
+} # type: Dict[str, Subcommand]
+
+# Leading options of the subcommands that take a value, so batch mode can tell them from inputs.
+VALUE_OPTIONS = ("-o", "-j",) # type: Tuple[str, ...]
+
+USAGE = """usage: python -m sgtools [-j N] [--manifest FILE | --stdin] SUBCOMMAND [ARGS...]
+       python -m sgtools [-j N] serve
+
+With --manifest or --stdin, inputs are also read one per line and added to ARGS,
+and with -j, they're shared out between N worker processes.
+Those only work for subcommands that take any number of inputs: """ + " ".join(sorted(
+    name for name, subcommand in SUBCOMMANDS.items() if subcommand.batchable
+)) + """
+serve reads one "SUBCOMMAND ARGS..." job per line from stdin and runs it,
+answering each with "N<TAB>ok" or "N<TAB>error MESSAGE" on stdout,
+where N counts jobs from 1. Anything the jobs print goes to stderr.
+
+subcommands: """ + " ".join(sorted(SUBCOMMANDS)) # type: str
+
+
+def main(): # type: () -> None
+    args = sys.argv[1:] # type: List[str]
+    workers = 1 # type: int
+    manifest_fname = None # type: Optional[str]
+    while args[:1] in (["-j"], ["--manifest"], ["--stdin"]):
+        if args[0] == "-j":
+            workers = int(args[1])
+            args = args[2:]
+        elif args[0] == "--manifest":
+            manifest_fname = args[1]
+            args = args[2:]
+        else:
+            manifest_fname = "-"
+            args = args[1:]
+
+    if args == [] or args[0] in ("-h", "--help"):
+        print(USAGE, file=sys.stderr)
+        raise SystemExit(0 if args != [] else 2)
+
+    if args[0] == "serve":
+        serve(sys.stdin, sys.stdout, workers=workers)
+        return
+
+    name = args[0] # type: str
+    subcommand = get_subcommand(name)
+    if not subcommand.batchable:
+        if manifest_fname is not None or workers > 1:
+            raise SystemExit(f"{name} can't be run in batch mode, so -j, --manifest and --stdin don't work with it")
+        run_subcommand(name, args[1:])
+        return
+
+    options, inputs = split_args(args[1:])
+    options += inputs[:subcommand.fixed_args]
+    inputs = inputs[subcommand.fixed_args:]
+    if manifest_fname == "-":
+        inputs += read_manifest(sys.stdin)
+    elif manifest_fname is not None:
+        with open(manifest_fname, "r", encoding="utf-8") as manifest_fp:
+            inputs += read_manifest(manifest_fp)
+
+    if workers <= 1 or len(inputs) <= 1:
+        run_inputs(name, options, inputs)
+    else:
+        run_batch(name, options, inputs, workers=workers)
+
+
+def split_args(args): # type: (List[str]) -> Tuple[List[str], List[str]]
+    """Splits a subcommand's arguments into its leading options and everything after them."""
+    pos = 0 # type: int
+    while pos < len(args) and args[pos].startswith("-") and args[pos] != "-":
+        pos += 2 if args[pos] in VALUE_OPTIONS else 1
+    return (args[:pos], args[pos:],)
+
+
+def read_manifest(fp): # type: (IO[str]) -> List[str]
+    """Reads one input per line, skipping blank lines and # comments."""
+    return [
+        line.strip()
+        for line in fp
+        if line.strip() != "" and not line.lstrip().startswith("#")
+    ]
+
+
+def get_subcommand(name): # type: (str) -> Subcommand
+    if name not in SUBCOMMANDS:
+        raise SystemExit(f"unknown subcommand {name!r}, expected one of: {' '.join(sorted(SUBCOMMANDS))}")
+    return SUBCOMMANDS[name]
+
+
+def run_subcommand(name, args): # type: (str, List[str]) -> None
+    """Runs a subcommand's main() as if args were its command line."""
+    module = importlib.import_module(get_subcommand(name).module_name)
+    old_argv = sys.argv # type: List[str]
+    sys.argv = [f"sgtools {name}"] + args
+    try:
+        module.main() # type: ignore[attr-defined]
+    finally:
+        sys.argv = old_argv
+
+
+def run_inputs(name, options, inputs): # type: (str, List[str], List[str]) -> None
+    """Runs a batchable subcommand over inputs."""
+    module = importlib.import_module(get_subcommand(name).module_name)
+    module.run(options + inputs) # type: ignore[attr-defined]
+
+
+def run_batch(name, options, inputs, *, workers): # type: (str, List[str], List[str], *, int) -> None
+    """Runs a batchable subcommand over inputs in worker processes, each taking an equal share."""
+    from sgtools.base.output import is_directory_spec
+
+    if "-o" in options and not is_directory_spec(options[options.index("-o")+1]):
+        raise SystemExit("-j only works with directory outputs, as each worker writes its own files")
+    for option in get_subcommand(name).batch_excludes:
+        if option in options:
+            raise SystemExit(f"-j doesn't work with {name} {option}")
+
+    shares = [inputs[i::workers] for i in range(workers)] # type: List[List[str]]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(run_inputs, name, options, share) for share in shares if share != []]:
+            future.result()
+
+
+def run_job(line): # type: (str) -> Optional[str]
+    """Runs one serve job, returning an error message if it failed."""
+    try:
+        args = shlex.split(line)
+        if args == []:
+            return "empty job"
+        with redirect_stdout(sys.stderr):
+            run_subcommand(args[0], args[1:])
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            return str(e.code)
+    except Exception as e:
+        traceback.print_exc(file=sys.stderr)
+        return f"{type(e).__name__}: {e}"
+    return None
+
+
+def serve(infp, outfp, *, workers=1): # type: (IO[str], IO[str], *, int) -> None
+    """Runs jobs read from infp until it ends, keeping every module imported between them.
+
+    With more than one worker, jobs run at once in worker processes and may finish out of order.
+    """
+    lock = threading.Lock() # type: threading.Lock
+
+    def answer(job_id, error): # type: (int, Optional[str]) -> None
+        reply = "ok" if error is None else "error " + error.replace("\n", " ")
+        with lock:
+            outfp.write(f"{job_id}\t{reply}\n")
+            outfp.flush()
+
+    if workers <= 1:
+        for job_id, line in enumerate(infp, 1):
+            answer(job_id, run_job(line))
+        return
+
+    def on_done(job_id, future): # type: (int, Future[Optional[str]]) -> None
+        # A worker that died takes its job with it, which still needs an answer.
+        try:
+            error = future.result() # type: Optional[str]
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+        answer(job_id, error)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for job_id, line in enumerate(infp, 1):
+            try:
+                future = executor.submit(run_job, line) # type: Future[Optional[str]]
+            except BrokenProcessPool as e:
+                answer(job_id, f"{type(e).__name__}: {e}")
+                continue
+            future.add_done_callback(lambda f, job_id=job_id: on_done(job_id, f))
+
+
+if __name__ == "__main__":
+    main()
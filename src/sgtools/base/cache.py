@@ -0,0 +1,95 @@
+#!/usr/bin/env python3 --
+# vim: set sts=4 sw=4 et :
+
+try:
+    from typing import TYPE_CHECKING
+except ImportError:
+    TYPE_CHECKING = False
+else:
+    from typing import Callable
+    from typing import Hashable
+    from typing import Optional
+    from typing import Union
+
+from collections import OrderedDict
+import threading
+
+
+DEFAULT_PAYLOAD_CACHE_BYTES = 64<<20 # type: int
+
+
+class LruByteCache:
+    """A least-recently-used cache of byte strings with a total size budget.
+
+    Values bigger than the whole budget are handed back but never kept.
+    """
+    __slots__ = (
+        "_max_bytes",
+        "_entries",
+        "_total_bytes",
+        "_lock",
+        "hits",
+        "misses",
+        "evictions",
+    )
+
+    def __init__(self, *, max_bytes): # type: (*, int) -> None
+        self._max_bytes = max_bytes # type: int
+        self._entries = OrderedDict() # type: OrderedDict[Hashable, Union[bytes, memoryview]]
+        self._total_bytes = 0 # type: int
+        self._lock = threading.Lock() # type: threading.Lock
+        self.hits = 0 # type: int
+        self.misses = 0 # type: int
+        self.evictions = 0 # type: int
+
+    def get_max_bytes(self): # type: () -> int
+        return self._max_bytes
+
+    def set_max_bytes(self, max_bytes): # type: (int) -> None
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    def get_total_bytes(self): # type: () -> int
+        return self._total_bytes
+
+    def get(self, key, loader): # type: (Hashable, Callable[[], Union[bytes, memoryview]]) -> Union[bytes, memoryview]
+        """Returns the value for key, calling loader to make it if it isn't cached."""
+        with self._lock:
+            value = self._entries.get(key) # type: Optional[Union[bytes, memoryview]]
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        # Don't hold the lock while loading, as that may be slow.
+        value = loader()
+
+        with self._lock:
+            if key not in self._entries and len(value) <= self._max_bytes:
+                self._entries[key] = value
+                self._total_bytes += len(value)
+                self._evict()
+        return value
+
+    def discard(self, key): # type: (Hashable) -> None
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._total_bytes -= len(value)
+
+    def clear(self): # type: () -> None
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def _evict(self): # type: () -> None
+        while self._total_bytes > self._max_bytes:
+            key, value = self._entries.popitem(last=False)
+            self._total_bytes -= len(value)
+            self.evictions += 1
+
+
+# Shared by every lazily-loaded file unless it is given its own.
+payload_cache = LruByteCache(max_bytes=DEFAULT_PAYLOAD_CACHE_BYTES) # type: LruByteCache
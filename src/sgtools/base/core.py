@@ -6,11 +6,18 @@ try:
 except ImportError:
     TYPE_CHECKING = False
 else:
+    from typing import Callable
+    from typing import Hashable
+    from typing import Iterable
+    from typing import Iterator
     from typing import Mapping
     from typing import IO
     from typing import List
+    from typing import Optional
+    from typing import Tuple
     from typing import Type
     from typing import TypeVar
+    from typing import Union
 
     TCoreFile = TypeVar("TCoreFile", bound="CoreFile")
     TUnknownFile = TypeVar("TUnknownFile", bound="UnknownFile")
@@ -18,6 +25,15 @@ else:
 
 from abc import ABCMeta
 from abc import abstractmethod
+from collections import deque
+import fnmatch
+
+from sgtools.base.cache import LruByteCache
+from sgtools.base.cache import payload_cache
+
+
+WALK_DEPTH_FIRST = "depth" # type: str
+WALK_BREADTH_FIRST = "breadth" # type: str
 
 
 class CoreFile(metaclass=ABCMeta):
@@ -40,19 +56,56 @@ class CoreFile(metaclass=ABCMeta):
 
 
 class UnknownFile(CoreFile):
-    """A file definition for an unknown file type."""
+    """A file definition for an unknown file type.
+
+    Instead of data, it can be given a loader,
+    in which case the data is only loaded when asked for,
+    and is kept in an LruByteCache (the shared payload_cache by default) rather than here.
+    It's cached under cache_key, which should name where the data comes from,
+    such as (archive path, member name), so the cache doesn't keep this file alive.
+    """
     __slots__ = (
         "_fname",
         "_data",
+        "_loader",
+        "_cache",
+        "_cache_key",
     )
 
-    def __init__(self, *, fname, data): # type: (str, bytes) -> None
+    def __init__(self, *, fname, data=None, loader=None, cache=None, cache_key=None): # type: (str, Optional[Union[bytes, memoryview]], Optional[Callable[[], Union[bytes, memoryview]]], Optional[LruByteCache], Optional[Hashable]) -> None
+        assert (data is None) != (loader is None)
         self._fname = fname
         self._data = data
+        self._loader = loader
+        self._cache = cache
+        # Without a key from the caller, a bare token still keeps the cache from pinning this file.
+        self._cache_key = cache_key if cache_key is not None else object() # type: Hashable
 
     def get_file_name(self): # type: () -> str
         return self._fname
 
+    def get_data(self): # type: () -> Union[bytes, memoryview]
+        if self._data is not None:
+            return self._data
+        assert self._loader is not None
+        cache = self._cache if self._cache is not None else payload_cache
+        return cache.get(self._cache_key, self._loader)
+
+    def get_cache_key(self): # type: () -> Hashable
+        return self._cache_key
+
+    def get_data_uncached(self): # type: () -> Union[bytes, memoryview]
+        """Like get_data, but doesn't put anything in the cache, for one-off reads."""
+        if self._data is not None:
+            return self._data
+        assert self._loader is not None
+        return self._loader()
+
+    @classmethod
+    def from_member(cls, *, fname, data=None, loader=None, header=None, cache=None, cache_key=None): # type: (Type[TUnknownFile], *, str, Optional[Union[bytes, memoryview]], Optional[Callable[[], Union[bytes, memoryview]]], Optional[bytes], Optional[LruByteCache], Optional[Hashable]) -> TUnknownFile
+        """Makes a file for an archive member. header is the start of its data, which isn't needed here."""
+        return cls(fname=fname, data=data, loader=loader, cache=cache, cache_key=cache_key)
+
     @classmethod
     def read_from_file_object(cls, *, fname, fp): # type: (Type[TUnknownFile], *, str, IO[bytes]) -> TUnknownFile
         return cls(fname=fname, data=fp.read())
@@ -70,6 +123,55 @@ class CoreDirectory(CoreFile, metaclass=ABCMeta):
     def save_files(self, file_map): # type: (Mapping[str, CoreFile]) -> None
         raise NotImplementedError()
 
+    def iter_files(self): # type: () -> Iterable[Tuple[str, CoreFile]]
+        """Iterates over the (name, file) pairs in this directory.
+
+        Subclasses should override this if they can do it without building a whole map.
+        """
+        return self.load_files().items()
+
+    def walk(self, *, order=WALK_DEPTH_FIRST, pattern=None, prune=None): # type: (*, str, Optional[str], Optional[Callable[[str, CoreDirectory], bool]]) -> Iterator[Tuple[str, CoreFile]]
+        """Walks everything under this directory, yielding (path, file) pairs.
+
+        Paths are "/"-separated and start with this directory's name.
+        Directories are yielded before their contents.
+        Only paths matching the glob pattern (if any) are yielded, ignoring case,
+        but everything is still descended into.
+        Subdirectories for which prune(path, directory) is true are not descended into.
+        """
+        if order == WALK_DEPTH_FIRST:
+            # A stack of iterators, so each directory is only iterated as far as needed.
+            stack = [(self.get_file_name(), iter(self.iter_files()),)] # type: List[Tuple[str, Iterator[Tuple[str, CoreFile]]]]
+            while len(stack) >= 1:
+                dir_path, dir_iter = stack[-1]
+                try:
+                    subfname, subfile = next(dir_iter)
+                except StopIteration:
+                    stack.pop()
+                    continue
+
+                path = dir_path + "/" + subfname # type: str
+                if pattern is None or fnmatch.fnmatchcase(path.upper(), pattern.upper()):
+                    yield (path, subfile,)
+                if isinstance(subfile, CoreDirectory):
+                    if prune is None or not prune(path, subfile):
+                        stack.append((path, iter(subfile.iter_files()),))
+
+        elif order == WALK_BREADTH_FIRST:
+            queue = deque([(self.get_file_name(), self,)]) # type: deque[Tuple[str, CoreDirectory]]
+            while len(queue) >= 1:
+                dir_path, directory = queue.popleft()
+                for subfname, subfile in directory.iter_files():
+                    path = dir_path + "/" + subfname
+                    if pattern is None or fnmatch.fnmatchcase(path.upper(), pattern.upper()):
+                        yield (path, subfile,)
+                    if isinstance(subfile, CoreDirectory):
+                        if prune is None or not prune(path, subfile):
+                            queue.append((path, subfile,))
+
+        else:
+            raise ValueError(f"unknown walk order {order!r}")
+
 
 class CoreArchive(CoreDirectory, metaclass=ABCMeta):
     """An archive file definition."""
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3 --
+# vim: set sts=4 sw=4 et :
+
+try:
+    from typing import TYPE_CHECKING
+except ImportError:
+    TYPE_CHECKING = False
+else:
+    from typing import Dict
+    from typing import IO
+    from typing import Optional
+    from typing import Union
+
+import hashlib
+import os
+import os.path
+import tempfile
+
+from sgtools.base.utils import ensure_dirs
+
+
+DEDUP_STORE_DIR = ".objects" # type: str
+DEDUP_MANIFEST_FNAME = "dedup-manifest.tsv" # type: str
+
+
+class DedupStore:
+    """Writes extracted files so that identical contents are only stored once.
+
+    Each file is hashed before anything is written, and only contents not seen before
+    go into a content store under root; its output path becomes a hardlink to the stored copy.
+    If the filesystem won't do hardlinks, the first copy is written out normally,
+    and later copies are listed in a manifest next to the store instead
+    as "path<TAB>path of first copy" lines. The manifest only covers the latest run.
+    """
+    __slots__ = (
+        "_root",
+        "_use_links",
+        "_seen",
+        "_manifest_fp",
+        "files",
+        "unique_files",
+        "bytes_written",
+        "bytes_saved",
+    )
+
+    def __init__(self, root): # type: (str) -> None
+        self._root = root # type: str
+        self._use_links = True # type: bool
+        self._seen = {} # type: Dict[str, str]
+        self._manifest_fp = None # type: Optional[IO[str]]
+        self.files = 0 # type: int
+        self.unique_files = 0 # type: int
+        self.bytes_written = 0 # type: int
+        self.bytes_saved = 0 # type: int
+
+    def __enter__(self): # type: () -> DedupStore
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback): # type: (object, object, object) -> None
+        self.close()
+
+    def close(self): # type: () -> None
+        if self._manifest_fp is not None:
+            self._manifest_fp.close()
+            self._manifest_fp = None
+        elif self.files > 0:
+            # Nothing needed listing this time, so an older manifest would only mislead.
+            try:
+                os.unlink(os.path.join(*[self._root, DEDUP_MANIFEST_FNAME]))
+            except FileNotFoundError:
+                pass
+
+    def _get_path(self, digest): # type: (str) -> str
+        return os.path.join(*[self._root, DEDUP_STORE_DIR, digest[:2], digest])
+
+    def write(self, out_fname, data): # type: (str, Union[bytes, bytearray, memoryview]) -> bool
+        """Writes a file, unless its data is already stored. Returns whether it was a duplicate."""
+        digest = hashlib.sha256(data).hexdigest() # type: str
+        self.files += 1
+        if self._use_links:
+            is_dup = self._write_linked(out_fname, data, digest)
+        else:
+            is_dup = self._write_listed(out_fname, data, digest)
+        self._seen.setdefault(digest, out_fname)
+
+        if is_dup:
+            self.bytes_saved += len(data)
+        else:
+            self.unique_files += 1
+            self.bytes_written += len(data)
+        return is_dup
+
+    def _write_linked(self, out_fname, data, digest): # type: (str, Union[bytes, bytearray, memoryview], str) -> bool
+        # Only this run's files count as duplicates; a stored copy from an earlier run is just reused.
+        is_dup = digest in self._seen # type: bool
+        obj_path = self._get_path(digest) # type: str
+        is_new = not os.path.exists(obj_path) # type: bool
+        if is_new:
+            obj_dir = os.path.dirname(obj_path) # type: str
+            ensure_dirs(obj_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=obj_dir, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as fp:
+                    fp.write(data)
+                os.replace(tmp_path, obj_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+        try:
+            os.unlink(out_fname)
+        except FileNotFoundError:
+            pass
+        try:
+            os.link(obj_path, out_fname)
+        except OSError:
+            # No hardlinks here, so keep a manifest from now on, and don't keep a second copy in the store.
+            self._use_links = False
+            if is_new:
+                os.unlink(obj_path)
+            return self._write_listed(out_fname, data, digest)
+        return is_dup
+
+    def _write_listed(self, out_fname, data, digest): # type: (str, Union[bytes, bytearray, memoryview], str) -> bool
+        first_fname = self._seen.get(digest) # type: Optional[str]
+        if first_fname is None:
+            _write_file(out_fname, data)
+            return False
+
+        # A file left here by an earlier run would contradict the manifest.
+        try:
+            os.unlink(out_fname)
+        except FileNotFoundError:
+            pass
+        if self._manifest_fp is None:
+            self._manifest_fp = open(os.path.join(*[self._root, DEDUP_MANIFEST_FNAME]), "w", encoding="utf-8")
+        self._manifest_fp.write(f"{out_fname}\t{first_fname}\n")
+        return True
+
+def _write_file(fname, data): # type: (str, Union[bytes, bytearray, memoryview]) -> None
+    with open(fname, "wb") as fp:
+        fp.write(data)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3 --
+# vim: set sts=4 sw=4 et :
+
+try:
+    from typing import TYPE_CHECKING
+except ImportError:
+    TYPE_CHECKING = False
+else:
+    from typing import IO
+    from typing import Iterator
+    from typing import List
+    from typing import Optional
+    from typing import Tuple
+    from typing import Union
+
+from contextlib import contextmanager
+import hashlib
+import os
+import os.path
+import shutil
+import tempfile
+
+from sgtools.base.utils import ensure_dirs
+
+
+DISK_CACHE_DIR_ENV = "SGTOOLS_CACHE_DIR" # type: str
+DISK_CACHE_MAX_BYTES_ENV = "SGTOOLS_CACHE_MAX_BYTES" # type: str
+DEFAULT_DISK_CACHE_MAX_BYTES = 1<<30 # type: int
+
+
+class DiskCache:
+    """A content-addressed on-disk cache of decoded outputs.
+
+    Keys come from make_key(), which hashes the input bytes along with
+    the name and version of whatever decoded them.
+    Entries are written to a temporary file and renamed into place,
+    so any number of processes can share one cache directory.
+    Reading an entry bumps its mtime, and the least recently used entries
+    are deleted once the cache grows past max_bytes.
+    """
+    __slots__ = (
+        "_root",
+        "_max_bytes",
+        "_total_bytes",
+    )
+
+    def __init__(self, root, *, max_bytes=DEFAULT_DISK_CACHE_MAX_BYTES): # type: (str, *, int) -> None
+        self._root = root # type: str
+        self._max_bytes = max_bytes # type: int
+        self._total_bytes = None # type: Optional[int]
+
+    @staticmethod
+    def make_key(kind, version, data): # type: (str, int, Union[bytes, bytearray, memoryview]) -> str
+        h = hashlib.sha256()
+        h.update(f"{kind}\x00{version}\x00".encode("utf-8"))
+        h.update(data)
+        return h.hexdigest()
+
+    def _get_path(self, key): # type: (str) -> str
+        return os.path.join(*[self._root, key[:2], key])
+
+    def open(self, key): # type: (str) -> Optional[IO[bytes]]
+        """Opens an entry for reading, or returns None if it isn't there."""
+        path = self._get_path(key)
+        try:
+            fp = open(path, "rb")
+        except FileNotFoundError:
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass # evicted in the meantime, but we have it open anyway
+        return fp
+
+    def get(self, key): # type: (str) -> Optional[bytes]
+        fp = self.open(key)
+        if fp is None:
+            return None
+        with fp:
+            return fp.read()
+
+    @contextmanager
+    def writer(self, key): # type: (str) -> Iterator[IO[bytes]]
+        """Writes an entry, which only appears if the block finishes without an exception."""
+        path = self._get_path(key)
+        ensure_dirs(os.path.dirname(path))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                yield fp
+            size = os.path.getsize(tmp_path) # type: int
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        self._added(size)
+
+    def put(self, key, data): # type: (str, Union[bytes, bytearray, memoryview]) -> None
+        with self.writer(key) as fp:
+            fp.write(data)
+
+    def put_file(self, key, fname): # type: (str, str) -> None
+        with open(fname, "rb") as infp:
+            with self.writer(key) as fp:
+                shutil.copyfileobj(infp, fp)
+
+    def _scan(self): # type: () -> List[Tuple[float, int, str]]
+        entries = [] # type: List[Tuple[float, int, str]]
+        try:
+            subdirs = os.listdir(self._root)
+        except FileNotFoundError:
+            return entries
+
+        for subdir in subdirs:
+            try:
+                names = os.listdir(os.path.join(*[self._root, subdir]))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for name in names:
+                if name.startswith(".tmp-"):
+                    continue
+                path = os.path.join(*[self._root, subdir, name])
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path,))
+        return entries
+
+    def _added(self, size): # type: (int) -> None
+        if self._total_bytes is None:
+            # First write from this process, so find out where we stand.
+            self._total_bytes = sum(entry[1] for entry in self._scan())
+        else:
+            self._total_bytes += size
+
+        if self._total_bytes > self._max_bytes:
+            self.evict()
+
+    def evict(self): # type: () -> None
+        """Deletes the least recently used entries until the cache fits its budget."""
+        entries = self._scan()
+        entries.sort()
+        total = sum(entry[1] for entry in entries) # type: int
+        for mtime, size, path in entries:
+            if total <= self._max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass # someone else got to it first
+            total -= size
+        self._total_bytes = total
+
+
+def get_default_disk_cache(): # type: () -> Optional[DiskCache]
+    """Returns the cache configured through the environment, or None if there isn't one."""
+    root = os.environ.get(DISK_CACHE_DIR_ENV, "") # type: str
+    if root == "":
+        return None
+    max_bytes = int(os.environ.get(DISK_CACHE_MAX_BYTES_ENV, str(DEFAULT_DISK_CACHE_MAX_BYTES))) # type: int
+    return DiskCache(root, max_bytes=max_bytes)
@@ -7,12 +7,129 @@ except ImportError:
     TYPE_CHECKING = False
 else:
     from typing import IO
+    from typing import Union
 
 
 from abc import ABCMeta
 from abc import abstractmethod
+import struct
+import zlib
+
+
+# Widens 6-bit VGA palette components to 8 bits, by repeating the top bits in the bottom ones.
+PALETTE_6TO8 = bytes([(((v<<6)|v)>>4) & 0xFF for v in range(256)]) # type: bytes
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n" # type: bytes
+DEFAULT_PNG_LEVEL = 6 # type: int
 
 
 class BaseImage(metaclass=ABCMeta):
-    __slots__ = ()
+    """An image that can be encoded to a few file formats."""
+    __slots__ = (
+        "_width",
+        "_height",
+    )
+
+    def __init__(self, *, width, height): # type: (*, int, int) -> None
+        self._width = width # type: int
+        self._height = height # type: int
+
+    def get_width(self): # type: () -> int
+        return self._width
+
+    def get_height(self): # type: () -> int
+        return self._height
+
+    @abstractmethod
+    def encode_tga(self): # type: () -> bytes
+        raise NotImplementedError()
+
+    @abstractmethod
+    def encode_png(self, *, level=DEFAULT_PNG_LEVEL): # type: (*, int) -> bytes
+        raise NotImplementedError()
+
+    def write_tga(self, fp): # type: (IO[bytes]) -> None
+        fp.write(self.encode_tga())
+
+    def write_png(self, fp, *, level=DEFAULT_PNG_LEVEL): # type: (IO[bytes], *, int) -> None
+        fp.write(self.encode_png(level=level))
+
+
+class IndexedImage(BaseImage):
+    """An 8-bit paletted image.
+
+    palette is 256 8-bit RGB triples, and pixels is one byte per pixel, top row first.
+    pixels is kept as a memoryview, so it can point into a bigger decoded buffer without a copy.
+    """
+    __slots__ = (
+        "_palette",
+        "_pixels",
+    )
+
+    def __init__(self, *, width, height, palette, pixels): # type: (*, int, int, bytes, Union[bytes, bytearray, memoryview]) -> None
+        super().__init__(width=width, height=height)
+        assert len(palette) == 256*3
+        self._palette = bytes(palette) # type: bytes
+        self._pixels = memoryview(pixels) # type: memoryview
+        assert len(self._pixels) == width*height
+
+    @classmethod
+    def from_vga(cls, *, width, height, palette, pixels): # type: (*, int, int, bytes, Union[bytes, bytearray, memoryview]) -> IndexedImage
+        """Makes an image with a 6-bit VGA palette."""
+        return cls(
+            width=width,
+            height=height,
+            palette=bytes(palette).translate(PALETTE_6TO8),
+            pixels=pixels,
+        )
+
+    def get_palette(self): # type: () -> bytes
+        return self._palette
+
+    def get_pixels(self): # type: () -> memoryview
+        return self._pixels
+
+    def encode_tga(self): # type: () -> bytes
+        """Encodes as an uncompressed colour-mapped TGA, top row first."""
+        # TGA colour maps are BGR.
+        palette = self._palette
+        bgr_palette = bytearray(256*3) # type: bytearray
+        bgr_palette[0::3] = palette[2::3]
+        bgr_palette[1::3] = palette[1::3]
+        bgr_palette[2::3] = palette[0::3]
+
+        return b"".join([
+            struct.pack("<BBB", 0, 1, 1),
+            struct.pack("<HHB", 0, 256, 24),
+            struct.pack("<HHHH", 0, 0, self._width, self._height),
+            struct.pack("<BB", 8, 0b00100000),
+            bgr_palette,
+            self._pixels,
+        ])
+
+    def encode_png(self, *, level=DEFAULT_PNG_LEVEL): # type: (*, int) -> bytes
+        """Encodes as a paletted PNG."""
+        width = self._width
+        pixels = self._pixels
+
+        # Every row gets a filter type byte in front, and filter type 0 is "none".
+        raw = bytearray((width+1)*self._height) # type: bytearray
+        for y in range(self._height):
+            raw[y*(width+1)+1:(y+1)*(width+1)] = pixels[y*width:(y+1)*width]
+
+        return b"".join([
+            PNG_SIGNATURE,
+            _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, self._height, 8, 3, 0, 0, 0)),
+            _png_chunk(b"PLTE", self._palette),
+            _png_chunk(b"IDAT", zlib.compress(raw, level)),
+            _png_chunk(b"IEND", b""),
+        ])
+
 
+def _png_chunk(chunk_type, data): # type: (bytes, bytes) -> bytes
+    return b"".join([
+        struct.pack(">I", len(data)),
+        chunk_type,
+        data,
+        struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))),
+    ])
@@ -7,16 +7,70 @@ except ImportError:
     TYPE_CHECKING = False
 else:
     from typing import IO
+    from typing import List
+    from typing import Optional
 
 
 from abc import ABCMeta
 from abc import abstractmethod
+import os
+import threading
+
+
+DEFAULT_CHUNK_SIZE = 1<<16 # type: int
+MANY_BATCH_BITS = 1<<9 # type: int
 
 
 class EndOfFileReached(Exception):
     pass
 
 
+class PositionalReader:
+    """Reads from a file at given offsets, without relying on its cursor.
+
+    Where the file has a descriptor and the OS has pread, that is used,
+    so any number of threads can read at once and the cursor never moves.
+    Otherwise it falls back to seek and read under a lock.
+    """
+    __slots__ = (
+        "_fp",
+        "_fd",
+        "_lock",
+    )
+
+    def __init__(self, fp): # type: (IO[bytes]) -> None
+        self._fp = fp # type: IO[bytes]
+        self._fd = None # type: Optional[int]
+        self._lock = threading.Lock() # type: threading.Lock
+
+        if hasattr(os, "pread"):
+            try:
+                self._fd = fp.fileno()
+            except (AttributeError, OSError):
+                pass
+
+    def read_at(self, offset, size): # type: (int, int) -> bytes
+        """Reads up to size bytes starting at offset."""
+        if self._fd is not None:
+            # pread can come up short, so keep going until it hits the end.
+            data = os.pread(self._fd, size, offset) # type: bytes
+            if len(data) == size or data == b"":
+                return data
+            parts = [data] # type: List[bytes]
+            got = len(data) # type: int
+            while got < size:
+                data = os.pread(self._fd, size - got, offset + got)
+                if data == b"":
+                    break
+                parts.append(data)
+                got += len(data)
+            return b"".join(parts)
+
+        with self._lock:
+            self._fp.seek(offset)
+            return self._fp.read(size)
+
+
 class BitReader(metaclass=ABCMeta):
     """Abstract interface for a bit-level reader stream."""
     __slots__ = (
@@ -35,39 +89,201 @@ class BitReader(metaclass=ABCMeta):
     def readbits(self, total): # type: (int) -> int
         """Reads a fixed number of bits and returns the result."""
         raise NotImplementedError()
-        
+
+    def readbits_many(self, total, count): # type: (int, int) -> List[int]
+        """Reads count fixed-width values and returns them as a list.
+
+        If the stream runs out first, returns the values read up to then, so the list can be short.
+        """
+        outl = [] # type: List[int]
+        try:
+            for i in range(count):
+                outl.append(self.readbits(total))
+        except EndOfFileReached:
+            pass
+        return outl
+
 
 class BitReaderLe(BitReader):
-    """Little-endian unswapped bit reader."""
+    """Little-endian unswapped bit reader.
+
+    The underlying file is read in chunks of chunk_size bytes,
+    so its cursor will generally be ahead of the bits consumed so far.
+    """
     __slots__ = (
         "_brem",
         "_bval",
+        "_buf",
+        "_bufpos",
+        "_chunk_size",
     )
 
-    def __init__(self, fp): # type: (IO[bytes]) -> None
+    def __init__(self, fp, *, chunk_size=DEFAULT_CHUNK_SIZE): # type: (IO[bytes], *, int) -> None
         super().__init__(fp)
         self._brem = 0 # type: int
         self._bval = 0 # type: int
+        self._buf = b"" # type: bytes
+        self._bufpos = 0 # type: int
+        self._chunk_size = chunk_size # type: int
 
     def sync(self): # type: () -> None
-        self._brem = 0
+        drop = self._brem & 0x7 # type: int
+        self._bval >>= drop
+        self._brem -= drop
 
-    def readbits(self, total): # type: (int) -> int
-        outv = 0 # type: int
-
-        for i in range(total):
-            if self._brem < 1:
-                assert self._brem == 0
-                b = self._fp.read(1)
-                if b == b"":
+    def _refill(self, total): # type: (int) -> None
+        """Tops the accumulator up to at least total bits, if possible."""
+        while self._brem < total:
+            if self._bufpos >= len(self._buf):
+                self._buf = self._fp.read(self._chunk_size)
+                self._bufpos = 0
+                if self._buf == b"":
                     raise EndOfFileReached("This is DEFINITELY the end of the file.")
-                self._bval = b[0]
-                self._brem = 8
 
-            if (self._bval & 0x01) != 0:
-                outv |= 1 << i
-            self._bval >>= 1
+            # Pull in enough whole bytes to cover the request in one go,
+            # but at least a machine word so short reads don't refill every time.
+            step = max(8, (total - self._brem + 7) >> 3) # type: int
+            chunk = self._buf[self._bufpos:self._bufpos+step] # type: bytes
+            self._bufpos += len(chunk)
+            self._bval |= int.from_bytes(chunk, "little") << self._brem
+            self._brem += len(chunk) << 3
 
-            self._brem -= 1
+    def readbits(self, total): # type: (int) -> int
+        if self._brem < total:
+            self._refill(total)
 
+        outv = self._bval & ((1 << total) - 1) # type: int
+        self._bval >>= total
+        self._brem -= total
         return outv
+
+    def read_rest(self): # type: () -> Optional[bytes]
+        """Reads all of the remaining bits as bytes, low bits first.
+
+        Returns None without reading anything if the stream isn't at a byte boundary.
+        """
+        if self._brem & 0x7:
+            return None
+        rest = self._bval.to_bytes(self._brem >> 3, "little") + self._buf[self._bufpos:] + self._fp.read() # type: bytes
+        self._bval = 0
+        self._brem = 0
+        self._buf = b""
+        self._bufpos = 0
+        return rest
+
+    def readbits_many(self, total, count): # type: (int, int) -> List[int]
+        """Reads count fixed-width values and returns them as a list.
+
+        If the stream runs out first, returns the values read up to then, so the list can be short.
+        Any bits left over that don't make a whole value are still there for readbits().
+        """
+        outl = [] # type: List[int]
+        mask = (1 << total) - 1 # type: int
+        while count >= 1:
+            # Keep the accumulator small, as shifting a huge int is not cheap.
+            batch = min(count, max(1, MANY_BATCH_BITS // total)) # type: int
+            try:
+                self._refill(total * batch)
+            except EndOfFileReached:
+                batch = self._brem // total
+                if batch == 0:
+                    break
+
+            bval = self._bval # type: int
+            for i in range(batch):
+                outl.append(bval & mask)
+                bval >>= total
+            self._bval = bval
+            self._brem -= total * batch
+            count -= batch
+
+        return outl
+
+
+class BitWriter(metaclass=ABCMeta):
+    """Abstract interface for a bit-level writer stream."""
+    __slots__ = (
+        "_fp",
+    )
+
+    def __init__(self, fp): # type: (IO[bytes]) -> None
+        self._fp = fp # type: IO[bytes]
+
+    @abstractmethod
+    def sync(self): # type: () -> None
+        """Pads with zero bits up to the nearest byte."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def flush(self): # type: () -> None
+        """Syncs, then writes everything so far to the file."""
+        raise NotImplementedError()
+
+    @abstractmethod
+    def writebits(self, value, total): # type: (int, int) -> None
+        """Writes value as a fixed number of bits."""
+        raise NotImplementedError()
+
+    def writebits_many(self, values, total): # type: (List[int], int) -> None
+        """Writes each value as a fixed number of bits."""
+        for value in values:
+            self.writebits(value, total)
+
+
+class BitWriterLe(BitWriter):
+    """Little-endian unswapped bit writer, the counterpart to BitReaderLe.
+
+    Output is collected and written to the underlying file in chunks of about chunk_size bytes.
+    """
+    __slots__ = (
+        "_bval",
+        "_bcount",
+        "_buf",
+        "_chunk_size",
+    )
+
+    def __init__(self, fp, *, chunk_size=DEFAULT_CHUNK_SIZE): # type: (IO[bytes], *, int) -> None
+        super().__init__(fp)
+        self._bval = 0 # type: int
+        self._bcount = 0 # type: int
+        self._buf = bytearray() # type: bytearray
+        self._chunk_size = chunk_size # type: int
+
+    def _drain(self): # type: () -> None
+        """Moves whole bytes from the accumulator to the buffer."""
+        nbytes = self._bcount >> 3 # type: int
+        self._buf += (self._bval & ((1 << (nbytes << 3)) - 1)).to_bytes(nbytes, "little")
+        self._bval >>= nbytes << 3
+        self._bcount -= nbytes << 3
+        if len(self._buf) >= self._chunk_size:
+            self._fp.write(self._buf)
+            self._buf = bytearray()
+
+    def sync(self): # type: () -> None
+        self._bcount = (self._bcount + 7) & ~0x7
+        self._drain()
+
+    def flush(self): # type: () -> None
+        self.sync()
+        if self._buf:
+            self._fp.write(self._buf)
+            self._buf = bytearray()
+
+    def writebits(self, value, total): # type: (int, int) -> None
+        assert 0 <= value < (1 << total)
+        self._bval |= value << self._bcount
+        self._bcount += total
+        if self._bcount >= MANY_BATCH_BITS:
+            self._drain()
+
+    def writebits_many(self, values, total): # type: (List[int], int) -> None
+        # Build up a batch at a time, as shifting a huge int is not cheap.
+        batch = max(1, MANY_BATCH_BITS // total) # type: int
+        for start in range(0, len(values), batch):
+            bval = 0 # type: int
+            chunk = values[start:start+batch] # type: List[int]
+            for value in reversed(chunk):
+                bval = (bval << total) | value
+            self._bval |= bval << self._bcount
+            self._bcount += total * len(chunk)
+            self._drain()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3 --
+# vim: set sts=4 sw=4 et :
+
+try:
+    from typing import TYPE_CHECKING
+except ImportError:
+    TYPE_CHECKING = False
+else:
+    from typing import ContextManager
+    from typing import IO
+    from typing import Iterable
+    from typing import Iterator
+    from typing import Optional
+    from typing import Set
+    from typing import Tuple
+    from typing import Union
+
+from abc import ABCMeta
+from abc import abstractmethod
+from contextlib import contextmanager
+from contextlib import nullcontext
+from contextlib import redirect_stdout
+import io
+import os
+import os.path
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+
+from sgtools.base.utils import ensure_dirs
+
+
+# Files bigger than this are spooled to a temporary file rather than memory while the tar header waits for their size.
+TAR_SPOOL_SIZE = 8<<20 # type: int
+
+
+class OutputBackend(metaclass=ABCMeta):
+    """Somewhere for extractors to write their output files to.
+
+    File names are relative paths using os.sep, as they would be under the current directory.
+    """
+    __slots__ = ()
+
+    def __enter__(self): # type: () -> OutputBackend
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback): # type: (object, object, object) -> None
+        self.close()
+
+    @abstractmethod
+    def open_file(self, fname): # type: (str) -> ContextManager[IO[bytes]]
+        """Opens a file for writing. It's complete once the with block ends."""
+        raise NotImplementedError()
+
+    def write_file(self, fname, data): # type: (str, Union[bytes, bytearray, memoryview]) -> None
+        with self.open_file(fname) as fp:
+            fp.write(data)
+
+    def write_chunks(self, fname, chunks): # type: (str, Iterable[Union[bytes, bytearray, memoryview]]) -> None
+        with self.open_file(fname) as fp:
+            for chunk in chunks:
+                fp.write(chunk)
+
+    def writes_to_stdout(self): # type: () -> bool
+        return False
+
+    def close(self): # type: () -> None
+        pass
+
+
+class DirectoryOutput(OutputBackend):
+    """Writes files into a directory, creating subdirectories as needed."""
+    __slots__ = (
+        "_root",
+        "_made_dirs",
+    )
+
+    def __init__(self, root="."): # type: (str) -> None
+        self._root = root # type: str
+        self._made_dirs = set() # type: Set[str]
+
+    def get_path(self, fname): # type: (str) -> str
+        return os.path.join(*[self._root, fname])
+
+    @contextmanager
+    def open_file(self, fname): # type: (str) -> Iterator[IO[bytes]]
+        path = self.get_path(fname)
+        dname = os.path.dirname(path) # type: str
+        if dname not in self._made_dirs:
+            # Only ask the filesystem once per directory.
+            ensure_dirs(dname or ".")
+            self._made_dirs.add(dname)
+        with open(path, "wb") as fp:
+            yield fp
+
+
+class TarOutput(OutputBackend):
+    """Writes files into a tar stream, which never seeks, so it can go to a pipe."""
+    __slots__ = (
+        "_tar",
+        "_mtime",
+    )
+
+    def __init__(self, *, fname=None, fp=None, compression=""): # type: (*, Optional[str], Optional[IO[bytes]], str) -> None
+        mode = "w|" + compression # type: str
+        self._tar = tarfile.open(name=fname, mode=mode, fileobj=fp) # type: tarfile.TarFile
+        self._mtime = int(time.time()) # type: int
+
+    def _make_info(self, fname, size): # type: (str, int) -> tarfile.TarInfo
+        info = tarfile.TarInfo(fname.replace(os.sep, "/"))
+        info.size = size
+        info.mtime = self._mtime
+        return info
+
+    @contextmanager
+    def open_file(self, fname): # type: (str) -> Iterator[IO[bytes]]
+        # The header needs the size up front, so hold onto the data until it's all there.
+        with tempfile.SpooledTemporaryFile(max_size=TAR_SPOOL_SIZE) as fp:
+            yield fp
+            size = fp.tell() # type: int
+            fp.seek(0)
+            self._tar.addfile(self._make_info(fname, size), fp)
+
+    def write_file(self, fname, data): # type: (str, Union[bytes, bytearray, memoryview]) -> None
+        self._tar.addfile(self._make_info(fname, len(data)), io.BytesIO(data))
+
+    def close(self): # type: () -> None
+        self._tar.close()
+
+
+class StdoutOutput(TarOutput):
+    """Writes a tar stream to stdout."""
+    __slots__ = ()
+
+    def __init__(self, *, compression=""): # type: (*, str) -> None
+        super().__init__(fp=sys.stdout.buffer, compression=compression)
+
+    def writes_to_stdout(self): # type: () -> bool
+        return True
+
+    def close(self): # type: () -> None
+        super().close()
+        sys.stdout.buffer.flush()
+
+
+class ZipOutput(OutputBackend):
+    """Writes files into a zip archive."""
+    __slots__ = (
+        "_zip",
+    )
+
+    def __init__(self, fname, *, compression=zipfile.ZIP_STORED): # type: (str, *, int) -> None
+        self._zip = zipfile.ZipFile(fname, "w", compression=compression) # type: zipfile.ZipFile
+
+    @contextmanager
+    def open_file(self, fname): # type: (str) -> Iterator[IO[bytes]]
+        with self._zip.open(fname.replace(os.sep, "/"), "w", force_zip64=True) as fp:
+            yield fp
+
+    def write_file(self, fname, data): # type: (str, Union[bytes, bytearray, memoryview]) -> None
+        self._zip.writestr(fname.replace(os.sep, "/"), bytes(data))
+
+    def close(self): # type: () -> None
+        self._zip.close()
+
+
+# Output names with these endings are archives rather than directories.
+ARCHIVE_OUTPUT_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.xz",) # type: Tuple[str, ...]
+
+# What to say when -o is given without an output to go with it.
+OUTPUT_OPTION_USAGE = "-o needs an output: a directory, a .zip, .tar, .tar.gz, .tgz or .tar.xz archive, or - for a tar stream on stdout" # type: str
+
+
+def is_directory_spec(spec): # type: (str) -> bool
+    """Tells whether open_output would write into a directory for spec."""
+    return spec != "-" and not spec.lower().endswith(ARCHIVE_OUTPUT_SUFFIXES)
+
+
+def open_output(spec): # type: (str) -> OutputBackend
+    """Picks a backend from a command-line argument.
+
+    "-" is a tar stream on stdout, names ending in .tar/.tar.gz/.tgz/.tar.xz/.zip are archives,
+    and anything else is a directory.
+    """
+    lspec = spec.lower() # type: str
+    if spec == "-":
+        return StdoutOutput()
+    elif lspec.endswith(".zip"):
+        return ZipOutput(spec, compression=zipfile.ZIP_DEFLATED)
+    elif lspec.endswith(".tar"):
+        return TarOutput(fname=spec)
+    elif lspec.endswith(".tar.gz") or lspec.endswith(".tgz"):
+        return TarOutput(fname=spec, compression="gz")
+    elif lspec.endswith(".tar.xz"):
+        return TarOutput(fname=spec, compression="xz")
+    else:
+        return DirectoryOutput(spec)
+
+
+def progress_to_stderr(output): # type: (OutputBackend) -> ContextManager[object]
+    """Sends progress messages to stderr if stdout is taken by the output itself."""
+    if output.writes_to_stdout():
+        return redirect_stdout(sys.stderr)
+    else:
+        return nullcontext()
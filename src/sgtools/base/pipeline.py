@@ -0,0 +1,120 @@
+#!/usr/bin/env python3 --
+# vim: set sts=4 sw=4 et :
+
+try:
+    from typing import TYPE_CHECKING
+except ImportError:
+    TYPE_CHECKING = False
+else:
+    from typing import Any
+    from typing import Awaitable
+    from typing import Callable
+    from typing import Iterable
+    from typing import Iterator
+    from typing import List
+    from typing import Optional
+    from typing import Tuple
+
+import asyncio
+from concurrent.futures import Executor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+
+
+# How many jobs can wait between two stages before the earlier one has to stop and wait.
+PIPELINE_QUEUE_SIZE = 8 # type: int
+
+# Marks the end of a queue.
+_DONE = object() # type: Any
+
+
+def run_pipeline(jobs, *, read, write, decode=None, max_workers=None, queue_size=PIPELINE_QUEUE_SIZE, use_processes=True): # type: (Iterable[Any], *, Callable[[Any], Any], Callable[[Any, Any], None], Optional[Callable[[Any, Any], Any]], Optional[int], int, bool) -> None
+    """Runs read, decode and write over jobs with all three stages going at once.
+
+    read(job) and write(job, decoded) each run on their own thread, one job at a time,
+    and jobs is iterated on the read thread too, so it can do blocking work of its own.
+    decode(job, data) runs on a pool of processes, or threads without use_processes,
+    so it and everything it's given and returns has to be picklable.
+    Without decode, whatever read returns goes straight to write.
+    Jobs are written in the order they come in,
+    and the stages are joined by queues of queue_size, so a slow stage holds the others back.
+    """
+    asyncio.run(_run_pipeline(
+        jobs,
+        read=read,
+        write=write,
+        decode=decode,
+        max_workers=max_workers,
+        queue_size=queue_size,
+        use_processes=use_processes,
+    ))
+
+
+async def _run_pipeline(jobs, *, read, write, decode, max_workers, queue_size, use_processes): # type: (Iterable[Any], *, Callable[[Any], Any], Callable[[Any, Any], None], Optional[Callable[[Any, Any], Any]], Optional[int], int, bool) -> None
+    loop = asyncio.get_running_loop()
+    read_queue = asyncio.Queue(maxsize=queue_size) # type: asyncio.Queue[Any]
+    write_queue = asyncio.Queue(maxsize=queue_size) # type: asyncio.Queue[Any]
+
+    with ThreadPoolExecutor(max_workers=1) as read_executor, ThreadPoolExecutor(max_workers=1) as write_executor:
+        decode_executor = None # type: Optional[Executor]
+        if decode is not None:
+            if use_processes:
+                decode_executor = ProcessPoolExecutor(max_workers=max_workers)
+            else:
+                decode_executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        job_iter = iter(jobs) # type: Iterator[Any]
+
+        def read_next(): # type: () -> Any
+            job = next(job_iter, _DONE) # type: Any
+            if job is _DONE:
+                return _DONE
+            return (job, read(job),)
+
+        async def read_stage(): # type: () -> None
+            while True:
+                item = await loop.run_in_executor(read_executor, read_next) # type: Any
+                await read_queue.put(item)
+                if item is _DONE:
+                    break
+
+        async def decode_stage(): # type: () -> None
+            while True:
+                item = await read_queue.get() # type: Any
+                if item is _DONE:
+                    break
+                job, data = item
+                if decode_executor is None:
+                    decoded = loop.create_future() # type: Awaitable[Any]
+                    decoded.set_result(data)
+                else:
+                    # Queue the pending result rather than waiting on it,
+                    # so up to queue_size jobs get decoded at once while write order is kept.
+                    decoded = loop.run_in_executor(decode_executor, decode, job, data)
+                await write_queue.put((job, decoded,))
+            await write_queue.put(_DONE)
+
+        async def write_stage(): # type: () -> None
+            while True:
+                item = await write_queue.get() # type: Any
+                if item is _DONE:
+                    break
+                job, decoded = item
+                await loop.run_in_executor(write_executor, write, job, await decoded)
+
+        tasks = [
+            loop.create_task(read_stage()),
+            loop.create_task(decode_stage()),
+            loop.create_task(write_stage()),
+        ] # type: List[asyncio.Task[None]]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Otherwise the other stages carry on, or wait forever on a queue that won't move.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            if decode_executor is not None:
+                decode_executor.shutdown(cancel_futures=True)
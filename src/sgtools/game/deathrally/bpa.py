@@ -1,131 +1,753 @@
 #!/usr/bin/env python3 --
 # vim: set sts=4 sw=4 et :
 
+import io
+import mmap
 import os
 import os.path
 import struct
 import sys
+import zlib
 
 try:
     from typing import TYPE_CHECKING
 except ImportError:
     TYPE_CHECKING = False
 else:
+    from typing import Dict
     from typing import Iterable
     from typing import IO
+    from typing import Iterator
     from typing import List
+    from typing import Optional
     from typing import Tuple
+    from typing import Union
 
+from sgtools.base.dedup import DedupStore
+from sgtools.base.io import PositionalReader
+from sgtools.base.output import DirectoryOutput
+from sgtools.base.output import OutputBackend
+from sgtools.base.output import OUTPUT_OPTION_USAGE
+from sgtools.base.output import open_output
+from sgtools.base.output import progress_to_stderr
+from sgtools.base.pipeline import run_pipeline
 from sgtools.base.utils import ensure_dirs
 
 OUT_ROOT_DIR = os.path.join(*["unpacked"]) # type: str
 
+# Buffer size for copying file data into an archive.
+COPY_BUFFER_SIZE = 1<<20 # type: int
+
+# Redo journal for update_bpa_member, kept next to the archive.
+JOURNAL_SUFFIX = ".journal" # type: str
+JOURNAL_MAGIC = b"BPAJ" # type: bytes
+# Magic, size field offset, data offset, data size, move source, destination and size, new archive size, chunk size.
+JOURNAL_HEADER_FORMAT = "<4sQQIQQQQQ" # type: str
+JOURNAL_HEADER_SIZE = struct.calcsize(JOURNAL_HEADER_FORMAT) # type: int
+# Chunk index plus one, and CRC-32 of that and the chunk.
+JOURNAL_SLOT_HEADER_FORMAT = "<QI" # type: str
+JOURNAL_SLOT_HEADER_SIZE = struct.calcsize(JOURNAL_SLOT_HEADER_FORMAT) # type: int
+
+
+# Per-column tables for undoing the filename encraption, built on first use.
+_fname_tables = None # type: Optional[List[bytes]]
+
 
 class BpaFatEntry:
+    """A file in a BPA archive.
+
+    If data isn't given up front, it is read from the reader on each access.
+    For a mapped archive, data is a memoryview into the mapping.
+    """
     __slots__ = (
         "fname",
-        "data",
+        "offset",
+        "size",
+        "_data",
+        "_reader",
     )
 
-    def __init__(self, *, fname, data): # type: (*, str, bytes) -> None
+    def __init__(self, *, fname, data=None, offset=0, size=None, reader=None): # type: (*, str, Optional[Union[bytes, memoryview]], int, Optional[int], Optional[BpaReader]) -> None
         self.fname = fname # type: str
-        self.data = data # type: bytes
+        self.offset = offset # type: int
+        if size is None:
+            assert data is not None
+            size = len(data)
+        self.size = size # type: int
+        self._data = data # type: Optional[Union[bytes, memoryview]]
+        self._reader = reader # type: Optional[BpaReader]
+
+    @property
+    def data(self): # type: () -> Union[bytes, memoryview]
+        return self.get_data()
+
+    def get_data(self): # type: () -> Union[bytes, memoryview]
+        if self._data is not None:
+            return self._data
+        assert self._reader is not None
+        return self._reader.read_data(self.offset, self.size)
+
+    def iter_chunks(self, chunk_size=COPY_BUFFER_SIZE): # type: (int) -> Iterator[Union[bytes, memoryview]]
+        """Yields the data in pieces, so a lazily-read file never has to be in memory all at once."""
+        if self._data is not None:
+            yield self._data
+            return
+        assert self._reader is not None
+        for pos in range(0, self.size, chunk_size):
+            yield self._reader.read_data(self.offset + pos, min(chunk_size, self.size - pos))
+
+
+class BpaMemberReader(io.RawIOBase):
+    """A read-only file object for one file in a lazily-read BPA archive."""
+
+    def __init__(self, bpa_reader, fat_entry): # type: (BpaReader, BpaFatEntry) -> None
+        super().__init__()
+        self._bpa_reader = bpa_reader # type: BpaReader
+        self._fat_entry = fat_entry # type: BpaFatEntry
+        self._pos = 0 # type: int
+
+    def readable(self): # type: () -> bool
+        return True
+
+    def seekable(self): # type: () -> bool
+        return True
+
+    def tell(self): # type: () -> int
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET): # type: (int, int) -> int
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self._fat_entry.size + offset
+        else:
+            raise ValueError(f"invalid whence {whence!r}")
+        self._pos = max(0, self._pos)
+        return self._pos
+
+    def readinto(self, buf): # type: (bytearray) -> int
+        size = max(0, min(len(buf), self._fat_entry.size - self._pos)) # type: int
+        if size == 0:
+            return 0
+        data = self._bpa_reader.read_data(self._fat_entry.offset + self._pos, size) # type: bytes
+        buf[:size] = data
+        self._pos += size
+        return size
 
 
 class BpaReader:
+    """Reader for a BPA archive.
+
+    In lazy mode only the FAT is read up front,
+    and each file's data is read from fp when it is asked for,
+    so fp has to stay open for as long as the reader is in use.
+    Reads go through positional I/O, so one reader can be shared between threads.
+
+    With use_mmap, fp is mapped read-only and each file's data is a memoryview into it.
+    The mapping outlives fp, and lasts until close() is called,
+    at which point the memoryviews handed out are released.
+    Anything sliced from them must be released first, or close() raises BufferError.
+    """
     __slots__ = (
         "_fname",
         "_fat",
         "_fp",
+        "_pfp",
+        "_lazy",
+        "_mmap",
+        "_view",
+        "_index",
     )
 
     def _get_max_fat_entries(self): # type: () -> int
         return 255
-        
-    def __init__(self, *, fname, fp): # type: (str, IO[bytes]) -> None
+
+    def __init__(self, *, fname, fp, lazy=False, use_mmap=False): # type: (str, IO[bytes], bool, bool) -> None
         self._fname = fname # type: str
         self._fp = fp # type: IO[bytes]
+        self._pfp = PositionalReader(fp) # type: PositionalReader
+        self._lazy = lazy # type: bool
+        self._mmap = None # type: Optional[mmap.mmap]
+        self._view = None # type: Optional[memoryview]
+        if use_mmap:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
         self._load_all()
 
+    def __enter__(self): # type: () -> BpaReader
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback): # type: (object, object, object) -> None
+        self.close()
+
+    def close(self): # type: () -> None
+        """Releases the mapping, if there is one."""
+        if self._mmap is None or self._view is None:
+            return
+
+        # Released views stay on the entries, so any later use fails loudly.
+        for fat_entry in self._fat:
+            if isinstance(fat_entry._data, memoryview):
+                fat_entry._data.release()
+        self._view.release()
+        self._mmap.close()
+        self._view = None
+        self._mmap = None
+
     def _load_all(self): # type: () -> None
-        self._fp.seek(0)
-        file_count, = struct.unpack("<I", self._fp.read(4)) # type: Tuple[int]
+        # The FAT is small and fixed-size, so grab it all in one go.
+        fat_size = 4 + (13+4)*self._get_max_fat_entries() # type: int
+        if self._view is not None:
+            raw_fat = bytes(self._view[:fat_size]) # type: bytes
+        else:
+            raw_fat = self._pfp.read_at(0, fat_size)
+        file_count, = struct.unpack("<I", raw_fat[:4]) # type: Tuple[int]
         assert file_count <= self._get_max_fat_entries()
-        self._fat = [] # type: List[BpaFatEntry]
-
-        # Here we juggle two pointers:
-        # the FAT pointer,
-        # and the pointer with all the file data.
-        #
-        # It's easier to load the fat in one go,
-        # but here I only need to create the file structures once.
-        #
-        # TODO: use a context manager for multiple file pointers.
-        # Or alternatively abuse mmap.
-        # Or just dump the whole thing into a byte array.
-
-        fat_ptr = self._fp.tell() # type: int
-        file_ptr = (4 + (13+4)*self._get_max_fat_entries()) # type: int
-        for fidx in range(file_count):
-            base_fname = self._read_encrapted_filename()
-            size, = struct.unpack("<I", self._fp.read(4)) # type: Tuple[int]
+        raw_fat = raw_fat[4:][:(13+4)*file_count]
+        assert len(raw_fat) == (13+4)*file_count
 
-            fat_ptr = self._fp.tell()
-            self._fp.seek(file_ptr)
+        fnames = self._decrypt_filenames(raw_fat, file_count)
 
-            data = self._fp.read(size) # type: bytes
-            assert len(data) == size
+        self._fat = [] # type: List[BpaFatEntry]
+        file_ptr = fat_size # type: int
+        for fidx in range(file_count):
+            size, = struct.unpack("<I", raw_fat[fidx*(13+4)+13:][:4]) # type: Tuple[int]
             self._fat.append(BpaFatEntry(
-                fname=base_fname,
-                data=data,
+                fname=fnames[fidx],
+                offset=file_ptr,
+                size=size,
+                reader=self,
             ))
+            file_ptr += size
 
-            file_ptr = self._fp.tell()
-            self._fp.seek(fat_ptr)
+        # DOS doesn't care about case, so neither do lookups.
+        self._index = {} # type: Dict[str, BpaFatEntry]
+        for fat_entry in self._fat:
+            self._index.setdefault(fat_entry.fname.upper(), fat_entry)
 
-    def _read_encrapted_filename(self): # type: () -> str
-        raw_fname = bytearray(self._fp.read(13)) # type: bytearray
-        for i in range(len(raw_fname)):
-            if raw_fname[i] != 0:
-                raw_fname[i] = (raw_fname[i] - (117 - 3*i)) & 0xFF
-        base_fname = bytes(raw_fname).partition(b"\x00")[0].decode("utf-8") # type: str
-        return base_fname
+        if self._view is not None:
+            # Nothing to read, just slice the mapping.
+            for fat_entry in self._fat:
+                data_view = self._view[fat_entry.offset:fat_entry.offset+fat_entry.size] # type: memoryview
+                assert len(data_view) == fat_entry.size
+                fat_entry._data = data_view
+
+        elif not self._lazy:
+            # The data follows the FAT in order, so this reads straight through.
+            for fat_entry in self._fat:
+                fat_entry._data = self.read_data(fat_entry.offset, fat_entry.size)
+
+    @staticmethod
+    def _decrypt_filenames(raw_fat, file_count): # type: (bytes, int) -> List[str]
+        """Decrypts every filename in the FAT at once."""
+        global _fname_tables
+
+        if _fname_tables is None:
+            _fname_tables = [
+                bytes([0] + [(v - (117 - 3*i)) & 0xFF for v in range(1, 256)])
+                for i in range(13)
+            ]
+
+        # Column i of every name uses the same table.
+        wfat = bytearray(raw_fat) # type: bytearray
+        for i in range(13):
+            wfat[i::13+4] = wfat[i::13+4].translate(_fname_tables[i])
+
+        return [
+            bytes(wfat[fidx*(13+4):][:13]).partition(b"\x00")[0].decode("utf-8")
+            for fidx in range(file_count)
+        ]
+
+    def read_data(self, offset, size): # type: (int, int) -> bytes
+        if self._view is not None:
+            return bytes(self._view[offset:offset+size])
+
+        data = self._pfp.read_at(offset, size) # type: bytes
+        assert len(data) == size
+        return data
 
     def each_fat_entry(self): # type: () -> Iterable[BpaFatEntry]
         return self._fat
 
+    def get_fat_entry(self, name): # type: (str) -> BpaFatEntry
+        """Looks up a file by name, ignoring case. Raises KeyError if it isn't there."""
+        return self._index[name.upper()]
+
+    def read_member(self, name): # type: (str) -> Union[bytes, memoryview]
+        return self.get_fat_entry(name).data
+
+    def open_member(self, name): # type: (str) -> IO[bytes]
+        """Opens a file for reading without loading the rest of it."""
+        fat_entry = self.get_fat_entry(name)
+        if fat_entry._data is not None:
+            return io.BytesIO(fat_entry._data)
+        return io.BufferedReader(BpaMemberReader(self, fat_entry))
+
     def get_fname(self): # type: () -> str
         return self._fname
 
 
+class BpaWriter:
+    """Writer for a BPA archive.
+
+    Files are streamed straight to fp as they are added,
+    and the FAT is filled in by close(), so fp must be seekable.
+    A file's data can be given as a bytes-like object, a file name, or a readable file object.
+    """
+    __slots__ = (
+        "_fname",
+        "_fp",
+        "_fat",
+        "_closed",
+    )
+
+    def _get_max_fat_entries(self): # type: () -> int
+        return 255
+
+    def __init__(self, *, fname, fp): # type: (str, IO[bytes]) -> None
+        self._fname = fname # type: str
+        self._fp = fp # type: IO[bytes]
+        self._fat = [] # type: List[Tuple[str, int]]
+        self._closed = False # type: bool
+
+        # Leave room for the FAT.
+        self._fp.seek(0)
+        self._fp.write(bytes(4 + (13+4)*self._get_max_fat_entries()))
+
+    def __enter__(self): # type: () -> BpaWriter
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback): # type: (object, object, object) -> None
+        if exc_type is None:
+            self.close()
+
+    def add_file(self, fname, source): # type: (str, Union[bytes, bytearray, memoryview, str, IO[bytes]]) -> None
+        assert not self._closed
+        if len(self._fat) >= self._get_max_fat_entries():
+            raise ValueError(f"too many files for {self._fname!r}, the limit is {self._get_max_fat_entries()}")
+        raw_fname = self._encrypt_filename(fname) # type: bytes
+
+        if isinstance(source, str):
+            with open(source, "rb") as infp:
+                size = self._copy_from(infp) # type: int
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            self._fp.write(source)
+            size = len(source)
+        else:
+            size = self._copy_from(source)
+
+        self._fat.append((fname, size,))
+
+    def _copy_from(self, infp): # type: (IO[bytes]) -> int
+        size = 0 # type: int
+        while True:
+            data = infp.read(COPY_BUFFER_SIZE) # type: bytes
+            if data == b"":
+                return size
+            self._fp.write(data)
+            size += len(data)
+
+    @staticmethod
+    def _encrypt_filename(fname): # type: (str) -> bytes
+        """Does the opposite of BpaReader._decrypt_filenames for one name."""
+        raw_fname = bytearray(fname.encode("utf-8")) # type: bytearray
+        if len(raw_fname) > 13 or b"\x00" in raw_fname:
+            raise ValueError(f"{fname!r} can't be stored in a BPA archive")
+        raw_fname += bytes(13 - len(raw_fname))
+        for i in range(len(raw_fname)):
+            if raw_fname[i] != 0:
+                raw_fname[i] = (raw_fname[i] + (117 - 3*i)) & 0xFF
+                if raw_fname[i] == 0:
+                    raise ValueError(f"{fname!r} can't be stored in a BPA archive")
+        return bytes(raw_fname)
+
+    def close(self): # type: () -> None
+        """Writes the FAT. The file object itself is left open."""
+        if self._closed:
+            return
+
+        fat = bytearray(struct.pack("<I", len(self._fat))) # type: bytearray
+        for fname, size in self._fat:
+            fat += self._encrypt_filename(fname)
+            fat += struct.pack("<I", size)
+
+        end = self._fp.tell() # type: int
+        self._fp.seek(0)
+        self._fp.write(fat)
+        self._fp.seek(end)
+        self._closed = True
+
+
+def write_bpa_file_name(bpa_fname, files): # type: (str, Iterable[Tuple[str, Union[bytes, bytearray, memoryview, str, IO[bytes]]]]) -> None
+    """Writes a whole BPA archive from (name, source) pairs.
+
+    It's written next to bpa_fname and renamed into place at the end,
+    so the sources can safely be read from the archive being replaced.
+    """
+    tmp_fname = bpa_fname + ".tmp" # type: str
+    try:
+        with open(tmp_fname, "wb") as outfp:
+            with BpaWriter(fname=bpa_fname, fp=outfp) as bpa_writer:
+                for fname, source in files:
+                    bpa_writer.add_file(fname, source)
+        os.replace(tmp_fname, bpa_fname)
+    except BaseException:
+        try:
+            os.unlink(tmp_fname)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def update_bpa_member(bpa_fname, name, data): # type: (str, str, Union[bytes, bytearray, memoryview]) -> None
+    """Replaces one file in a BPA archive, only rewriting what has to change.
+
+    Files are stored back to back, so if the size is unchanged (or it's the last file)
+    the data is overwritten where it is, and otherwise everything after it is shifted along.
+    The new data and where it goes are saved to a journal first,
+    and if we crash part way through, the next update or recover_bpa_file_name() finishes the job.
+    """
+    recover_bpa_file_name(bpa_fname)
+
+    with open(bpa_fname, "r+b") as fp:
+        bpa_reader = BpaReader(
+            fname=bpa_fname,
+            fp=fp,
+            lazy=True,
+        )
+        fat_entry = bpa_reader.get_fat_entry(name)
+        fidx = bpa_reader._fat.index(fat_entry) # type: int
+        old_end = os.fstat(fp.fileno()).st_size # type: int
+        tail_offset = fat_entry.offset + fat_entry.size # type: int
+        delta = len(data) - fat_entry.size # type: int
+
+        _write_journal(
+            bpa_fname,
+            size_offset=4 + (13+4)*fidx + 13,
+            data_offset=fat_entry.offset,
+            data=data,
+            move_src=tail_offset,
+            move_dst=tail_offset + delta,
+            move_size=old_end - tail_offset,
+            new_end=old_end + delta,
+        )
+        with open(bpa_fname + JOURNAL_SUFFIX, "r+b") as jfp:
+            _apply_journal(fp, jfp)
+
+    os.unlink(bpa_fname + JOURNAL_SUFFIX)
+    _fsync_dir(bpa_fname)
+
+
+def recover_bpa_file_name(bpa_fname): # type: (str) -> bool
+    """Finishes an update that didn't. Returns whether there was one."""
+    journal_fname = bpa_fname + JOURNAL_SUFFIX # type: str
+    try:
+        # A journal that never got renamed into place means the archive wasn't touched yet.
+        os.unlink(journal_fname + ".tmp")
+    except FileNotFoundError:
+        pass
+
+    try:
+        jfp = open(journal_fname, "r+b")
+    except FileNotFoundError:
+        return False
+
+    with jfp, open(bpa_fname, "r+b") as fp:
+        _apply_journal(fp, jfp)
+
+    os.unlink(journal_fname)
+    _fsync_dir(bpa_fname)
+    return True
+
+
+def _write_journal(bpa_fname, *, size_offset, data_offset, data, move_src, move_dst, move_size, new_end): # type: (str, *, int, int, Union[bytes, bytearray, memoryview], int, int, int, int) -> None
+    """Saves what an update is going to do, only making the journal visible once it's all on disk.
+
+    That's the new size and data, and the shift of everything after them.
+    The shift's chunks go in two slots after the data as it runs, see _move_data.
+    """
+    journal_fname = bpa_fname + JOURNAL_SUFFIX # type: str
+    with open(journal_fname + ".tmp", "wb") as jfp:
+        jfp.write(struct.pack(
+            JOURNAL_HEADER_FORMAT,
+            JOURNAL_MAGIC,
+            size_offset,
+            data_offset,
+            len(data),
+            move_src,
+            move_dst,
+            move_size,
+            new_end,
+            COPY_BUFFER_SIZE,
+        ))
+        jfp.write(data)
+        jfp.flush()
+        os.fsync(jfp.fileno())
+    os.replace(journal_fname + ".tmp", journal_fname)
+    _fsync_dir(bpa_fname)
+
+
+def _apply_journal(fp, jfp): # type: (IO[bytes], IO[bytes]) -> None
+    """Carries out the update saved in a journal, from wherever it got to.
+
+    Every step is safe to repeat, so this can be cut short and run again any number of times.
+    """
+    header = jfp.read(JOURNAL_HEADER_SIZE) # type: bytes
+    if len(header) != JOURNAL_HEADER_SIZE or header[:4] != JOURNAL_MAGIC:
+        raise ValueError(f"{jfp.name!r} is not a BPA journal")
+    (
+        _,
+        size_offset,
+        data_offset,
+        data_size,
+        move_src,
+        move_dst,
+        move_size,
+        new_end,
+        chunk_size,
+    ) = struct.unpack(JOURNAL_HEADER_FORMAT, header) # type: Tuple[bytes, int, int, int, int, int, int, int, int]
+    data = jfp.read(data_size) # type: bytes
+    assert len(data) == data_size, "journal is truncated"
+    slot_offset = JOURNAL_HEADER_SIZE + data_size # type: int
+
+    # Redo the last chunk that was saved, in case writing it got cut short,
+    # since its source may already have been overwritten by then.
+    start = 0 # type: int
+    last_slot = _read_last_slot(jfp, slot_offset, move_src, move_dst, move_size, chunk_size)
+    if last_slot is not None:
+        chunk_idx, chunk = last_slot
+        pos, _ = _get_chunk_span(chunk_idx, move_src, move_dst, move_size, chunk_size)
+        fp.seek(move_dst + pos)
+        fp.write(chunk)
+        fp.flush()
+        os.fsync(fp.fileno())
+        start = chunk_idx + 1
+    _move_data(fp, move_src, move_dst, move_size, chunk_size=chunk_size, start=start, jfp=jfp, slot_offset=slot_offset)
+
+    fp.seek(size_offset)
+    fp.write(struct.pack("<I", data_size))
+    fp.seek(data_offset)
+    fp.write(data)
+    fp.truncate(new_end)
+    fp.flush()
+    os.fsync(fp.fileno())
+
+
+def _read_last_slot(jfp, slot_offset, src, dst, size, chunk_size): # type: (IO[bytes], int, int, int, int, int) -> Optional[Tuple[int, bytes]]
+    """Returns the index and data of the newest intact chunk saved by _move_data, if there is one."""
+    if src == dst or size == 0:
+        return None
+
+    chunk_count = (size + chunk_size - 1) // chunk_size # type: int
+    last_slot = None # type: Optional[Tuple[int, bytes]]
+    for sidx in range(2):
+        jfp.seek(slot_offset + sidx*(JOURNAL_SLOT_HEADER_SIZE + chunk_size))
+        slot_header = jfp.read(JOURNAL_SLOT_HEADER_SIZE) # type: bytes
+        if len(slot_header) != JOURNAL_SLOT_HEADER_SIZE:
+            continue
+        seq, crc = struct.unpack(JOURNAL_SLOT_HEADER_FORMAT, slot_header) # type: Tuple[int, int]
+        if not (0 < seq <= chunk_count) or (seq - 1) % 2 != sidx:
+            continue
+        chunk = jfp.read(_get_chunk_span(seq - 1, src, dst, size, chunk_size)[1]) # type: bytes
+        if zlib.crc32(struct.pack("<Q", seq) + chunk) != crc:
+            continue # torn, so its chunk was never written
+        if last_slot is None or seq - 1 > last_slot[0]:
+            last_slot = (seq - 1, chunk,)
+    return last_slot
+
+
+def _get_chunk_span(chunk_idx, src, dst, size, chunk_size): # type: (int, int, int, int, int) -> Tuple[int, int]
+    """Returns where the given chunk of a move starts, relative to src and dst, and how long it is."""
+    if dst > src:
+        # Back to front, so the source isn't clobbered before it's copied.
+        end = size - chunk_idx*chunk_size # type: int
+        pos = max(end - chunk_size, 0) # type: int
+        return (pos, end - pos,)
+    else:
+        pos = chunk_idx*chunk_size
+        return (pos, min(chunk_size, size - pos),)
+
+
+def _move_data(fp, src, dst, size, *, chunk_size=COPY_BUFFER_SIZE, start=0, jfp=None, slot_offset=0): # type: (IO[bytes], int, int, int, *, int, int, Optional[IO[bytes]], int) -> None
+    """Moves size bytes from src to dst within fp, copying in the order that doesn't clobber the source.
+
+    Given a journal, each chunk is saved in it before being written, alternating between two slots,
+    so a move that was cut short can be carried on from the chunk after the last one saved.
+    """
+    if src == dst or size == 0:
+        return
+
+    chunk_count = (size + chunk_size - 1) // chunk_size # type: int
+    for chunk_idx in range(start, chunk_count):
+        pos, length = _get_chunk_span(chunk_idx, src, dst, size, chunk_size)
+        fp.seek(src + pos)
+        chunk = fp.read(length) # type: bytes
+        assert len(chunk) == length
+        if jfp is not None:
+            seq = chunk_idx + 1 # type: int
+            jfp.seek(slot_offset + (chunk_idx % 2)*(JOURNAL_SLOT_HEADER_SIZE + chunk_size))
+            jfp.write(struct.pack(JOURNAL_SLOT_HEADER_FORMAT, seq, zlib.crc32(struct.pack("<Q", seq) + chunk)))
+            jfp.write(chunk)
+            jfp.flush()
+            os.fsync(jfp.fileno())
+        fp.seek(dst + pos)
+        fp.write(chunk)
+        if jfp is not None:
+            # It has to be on disk before the next chunk takes over the other slot.
+            fp.flush()
+            os.fsync(fp.fileno())
+
+
+def _fsync_dir(fname): # type: (str) -> None
+    """Makes a rename or unlink next to fname durable, where the OS lets us."""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(fname)), os.O_RDONLY)
+    except OSError:
+        return # e.g. Windows, which can't open directories
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
 def main(): # type: () -> None
-    for bpa_fname in sys.argv[1:]:
-        with open(bpa_fname, "rb") as infp:
-            bpa_reader = BpaReader(
-                fname=bpa_fname,
-                fp=infp,
-            )
-            process_bpa_archive(bpa_reader)
+    run(sys.argv[1:])
 
 
-def process_bpa_archive(bpa_reader): # type: (BpaReader) -> None
-    bpa_fname = bpa_reader.get_fname() # type: str
-    print(f"Processing {bpa_fname}")
+def run(args): # type: (List[str]) -> None
+    """Does what main() does, for args instead of the command line: leading options, then the files."""
+    bpa_fnames = list(args) # type: List[str]
+    use_dedup = False # type: bool
+    pipelined = False # type: bool
+    output_spec = "." # type: str
+    while bpa_fnames[:1] in (["--dedup"], ["--pipeline"], ["-o"]):
+        if bpa_fnames[0] == "--dedup":
+            use_dedup = True
+            bpa_fnames = bpa_fnames[1:]
+        elif bpa_fnames[0] == "--pipeline":
+            pipelined = True
+            bpa_fnames = bpa_fnames[1:]
+        else:
+            if len(bpa_fnames) < 2:
+                raise SystemExit(OUTPUT_OPTION_USAGE)
+            output_spec = bpa_fnames[1]
+            bpa_fnames = bpa_fnames[2:]
+
+    with open_output(output_spec) as output:
+        dedup = None # type: Optional[DedupStore]
+        if use_dedup:
+            if not isinstance(output, DirectoryOutput):
+                raise SystemExit("--dedup only works when extracting to a directory")
+            dedup = DedupStore(output.get_path(OUT_ROOT_DIR))
+
+        with progress_to_stderr(output):
+            if pipelined:
+                process_bpa_archives_pipelined(bpa_fnames, dedup=dedup, output=output)
+            else:
+                for bpa_fname in bpa_fnames:
+                    with open(bpa_fname, "rb") as infp:
+                        bpa_reader = BpaReader(
+                            fname=bpa_fname,
+                            fp=infp,
+                            lazy=True,
+                        )
+                        process_bpa_archive(bpa_reader, dedup=dedup, output=output)
 
+            if dedup is not None:
+                dedup.close()
+                print(f"{dedup.files} files, {dedup.unique_files} unique, {dedup.bytes_written} bytes written, {dedup.bytes_saved} bytes saved")
+
+
+def _get_out_root(bpa_fname): # type: (str) -> str
     if "." in bpa_fname:
         bpa_root = bpa_fname.rpartition(".")[0] # type: str
     else:
         bpa_root = bpa_fname
 
-    out_root = os.path.join(*[OUT_ROOT_DIR, bpa_root])
-    ensure_dirs(out_root)
+    return os.path.join(*[OUT_ROOT_DIR, bpa_root])
+
+
+def process_bpa_archive(bpa_reader, *, dedup=None, output=None): # type: (BpaReader, *, Optional[DedupStore], Optional[OutputBackend]) -> None
+    """Extracts every file in an archive to output, or the current directory if there isn't one.
+
+    With dedup, identical files across every archive it's used for are only stored once.
+    That needs output to be a directory.
+    """
+    if output is None:
+        output = DirectoryOutput()
+
+    bpa_fname = bpa_reader.get_fname() # type: str
+    print(f"Processing {bpa_fname}")
+
+    out_root = _get_out_root(bpa_fname)
+    if dedup is not None:
+        assert isinstance(output, DirectoryOutput)
+        ensure_dirs(output.get_path(out_root))
 
     for fat_entry in bpa_reader.each_fat_entry():
         out_fname = os.path.join(*[out_root, fat_entry.fname])
-        data = fat_entry.data
-        print(f"- {out_fname!r} {len(data)}")
-        with open(out_fname, "wb") as outfp:
-            outfp.write(fat_entry.data)
+        if dedup is not None:
+            is_dup = dedup.write(output.get_path(out_fname), fat_entry.get_data()) # type: bool
+            print(f"- {out_fname!r} {fat_entry.size}{' (duplicate)' if is_dup else ''}")
+            continue
+
+        print(f"- {out_fname!r} {fat_entry.size}")
+        output.write_chunks(out_fname, fat_entry.iter_chunks())
+
+
+def process_bpa_archives_pipelined(bpa_fnames, *, dedup=None, output=None): # type: (List[str], *, Optional[DedupStore], Optional[OutputBackend]) -> None
+    """Like process_bpa_archive for each archive, but reading the next files while writing the last ones.
+
+    There's nothing to decode, so this is just two threads with a queue between them.
+    """
+    if output is None:
+        output = DirectoryOutput()
+
+    def each_job(): # type: () -> Iterator[Tuple[Optional[str], str, BpaFatEntry]]
+        for bpa_fname in bpa_fnames:
+            out_root = _get_out_root(bpa_fname)
+            with open(bpa_fname, "rb") as infp:
+                bpa_reader = BpaReader(
+                    fname=bpa_fname,
+                    fp=infp,
+                    lazy=True,
+                )
+                # The read stage is done with each file before asking for the next,
+                # so infp is open for as long as it's needed.
+                first_fname = bpa_fname # type: Optional[str]
+                for fat_entry in bpa_reader.each_fat_entry():
+                    yield (first_fname, out_root, fat_entry,)
+                    first_fname = None
+
+    def read(job): # type: (Tuple[Optional[str], str, BpaFatEntry]) -> bytes
+        return bytes(job[2].get_data())
+
+    def write(job, data): # type: (Tuple[Optional[str], str, BpaFatEntry], bytes) -> None
+        first_fname, out_root, fat_entry = job
+        if first_fname is not None:
+            print(f"Processing {first_fname}")
+            if dedup is not None:
+                assert isinstance(output, DirectoryOutput)
+                ensure_dirs(output.get_path(out_root))
+
+        out_fname = os.path.join(*[out_root, fat_entry.fname])
+        if dedup is not None:
+            assert isinstance(output, DirectoryOutput)
+            is_dup = dedup.write(output.get_path(out_fname), data) # type: bool
+            print(f"- {out_fname!r} {len(data)}{' (duplicate)' if is_dup else ''}")
+        else:
+            print(f"- {out_fname!r} {len(data)}")
+            output.write_file(out_fname, data)
+
+    run_pipeline(
+        each_job(),
+        read=read,
+        write=write,
+    )
 
 
 if __name__ == "__main__":
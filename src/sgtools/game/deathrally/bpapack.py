@@ -0,0 +1,35 @@
+#!/usr/bin/env python3 --
+# vim: set sts=4 sw=4 et :
+
+import os.path
+import sys
+
+try:
+    from typing import TYPE_CHECKING
+except ImportError:
+    TYPE_CHECKING = False
+else:
+    from typing import List
+
+from sgtools.game.deathrally.bpa import write_bpa_file_name
+
+
+def main(): # type: () -> None
+    bpa_fname = sys.argv[1] # type: str
+    in_fnames = sys.argv[2:] # type: List[str]
+    pack_bpa_archive(bpa_fname, in_fnames)
+
+
+def pack_bpa_archive(bpa_fname, in_fnames): # type: (str, List[str]) -> None
+    """Packs files into a BPA archive, each stored under its base name."""
+    print(f"Packing {bpa_fname}")
+    for in_fname in in_fnames:
+        print(f"- {in_fname!r}")
+    write_bpa_file_name(bpa_fname, [
+        (os.path.basename(in_fname), in_fname,)
+        for in_fname in in_fnames
+    ])
+
+
+if __name__ == "__main__":
+    main()
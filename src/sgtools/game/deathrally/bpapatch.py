@@ -0,0 +1,34 @@
+#!/usr/bin/env python3 --
+# vim: set sts=4 sw=4 et :
+
+import os.path
+import sys
+
+try:
+    from typing import TYPE_CHECKING
+except ImportError:
+    TYPE_CHECKING = False
+else:
+    from typing import List
+
+from sgtools.game.deathrally.bpa import update_bpa_member
+
+
+def main(): # type: () -> None
+    bpa_fname = sys.argv[1] # type: str
+    in_fnames = sys.argv[2:] # type: List[str]
+    patch_bpa_archive(bpa_fname, in_fnames)
+
+
+def patch_bpa_archive(bpa_fname, in_fnames): # type: (str, List[str]) -> None
+    """Replaces files in a BPA archive with the ones of the same base name."""
+    print(f"Patching {bpa_fname}")
+    for in_fname in in_fnames:
+        with open(in_fname, "rb") as infp:
+            data = infp.read() # type: bytes
+        print(f"- {in_fname!r} {len(data)}")
+        update_bpa_member(bpa_fname, os.path.basename(in_fname), data)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3 --
 # vim: set sts=4 sw=4 et :
 
+from array import array
+import io
 import os
 import os.path
 import struct
@@ -11,22 +13,48 @@ try:
 except ImportError:
     TYPE_CHECKING = False
 else:
+    from typing import Any
     from typing import Dict
     from typing import IO
+    from typing import Iterable
+    from typing import Iterator
     from typing import List
     from typing import Optional
     from typing import Tuple
+    from typing import Union
 
+from sgtools.base.io import DEFAULT_CHUNK_SIZE
 from sgtools.base.io import BitReader
 from sgtools.base.io import BitReaderLe
+from sgtools.base.io import BitWriter
+from sgtools.base.io import BitWriterLe
+from sgtools.base.core import UnknownFile
+from sgtools.base.diskcache import DiskCache
+from sgtools.base.diskcache import get_default_disk_cache
+from sgtools.base.image import IndexedImage
 from sgtools.base.io import EndOfFileReached
-from sgtools.base.utils import ensure_dirs
+from sgtools.base.output import DirectoryOutput
+from sgtools.base.output import OutputBackend
+from sgtools.base.output import OUTPUT_OPTION_USAGE
+from sgtools.base.output import open_output
+from sgtools.base.output import progress_to_stderr
+from sgtools.base.pipeline import run_pipeline
+from sgtools.game.deathrally.formats import FORMAT_BPK
+from sgtools.game.deathrally.formats import FORMAT_RIX3
+from sgtools.game.deathrally.formats import FileFormat
+from sgtools.game.deathrally.formats import detect_format
 
 OUT_ROOT_DIR = os.path.join(*["unpacked"]) # type: str
 
 #DEBUG_RAW_READS = True
 DEBUG_RAW_READS = False
 
+# Bump this whenever a change to the decoder could change its output, to invalidate cached results.
+LZW_DECODER_VERSION = 1 # type: int
+
+# How much already-returned output a streaming LzwDecoder keeps around for reuse.
+LZW_WINDOW_SIZE = 1<<16 # type: int
+
 TGA_SIZE_PAL_MAPS = {
     2250: (15, 150, "MENU.PAL",), # palette is kinda wrong here
     4096: (64, 64, "MENU.PAL",),
@@ -36,6 +64,75 @@ TGA_SIZE_PAL_MAPS = {
     640*480: (640, 480, None,),
 } # type: Dict[int, Tuple[int, int, Optional[str]]]
 
+RIX3_HEADER_SIZE = 0xA + 256*3 # type: int
+
+IMAGE_FORMAT_TGA = "tga" # type: str
+IMAGE_FORMAT_PNG = "png" # type: str
+DEFAULT_IMAGE_FORMATS = (IMAGE_FORMAT_TGA,) # type: Tuple[str, ...]
+
+# Anything longer can only be turned into an image if it's a RIX3 file.
+TGA_MAX_SIZE_MAP_LENGTH = max(TGA_SIZE_PAL_MAPS) # type: int
+
+# How much of the start of a file identify() needs to look at.
+BPK_SNIFF_SIZE = 0xA # type: int
+
+BPK_KIND_RAW = "raw" # type: str
+BPK_KIND_RIX3 = "RIX3" # type: str
+BPK_KIND_SIZE_MAP = "size_map" # type: str
+
+# Undoes the literal byte mapping in LzwReader.reset_tables.
+LZW_ENCODE_MAP = bytes([((v<<3)&0xFF) | (v>>(8-3)) for v in range(256)]) # type: bytes
+# The literal byte mapping itself.
+LZW_DECODE_MAP = bytes([((v>>3)&0xFF) | (v<<(8-3)&0xFF) for v in range(256)]) # type: bytes
+
+# The decoder's table stops growing at this code.
+LZW_TABLE_LIMIT = (1<<12)-1 # type: int
+# Code widths after a reset, each with how many data codes are read before the next width.
+# The table gains an entry per data code after the first, and widens once it's outgrown the current width.
+LZW_WIDTH_STEPS = ((9, 255,), (10, 767,), (11, 1791,), (12, None,),) # type: Tuple[Tuple[int, Optional[int]], ...]
+# How many codes the NumPy decoder unpacks at once, so a reset doesn't waste much work.
+LZW_NUMPY_BLOCK_CODES = 4096 # type: int
+
+
+class BpkInfo:
+    """What kind of image (if any) a decoded BPK file holds.
+
+    For RIX3 files the palette is embedded, so pal_fname is None.
+    For size-mapped files, pal_fname is the palette file to use.
+    length is None if it was never needed to work out the kind.
+    """
+    __slots__ = (
+        "kind",
+        "width",
+        "height",
+        "pal_fname",
+        "length",
+    )
+
+    def __init__(self, *, kind, width, height, pal_fname, length): # type: (*, str, int, int, Optional[str], Optional[int]) -> None
+        self.kind = kind # type: str
+        self.width = width # type: int
+        self.height = height # type: int
+        self.pal_fname = pal_fname # type: Optional[str]
+        self.length = length # type: Optional[int]
+
+    def __repr__(self): # type: () -> str
+        return f"BpkInfo(kind={self.kind!r}, width={self.width!r}, height={self.height!r}, pal_fname={self.pal_fname!r}, length={self.length!r})"
+
+
+class DeathRallyBpkFile(UnknownFile):
+    """An LZW-compressed BPK file, which is only decoded when asked for."""
+    __slots__ = ()
+
+    def get_decoder(self): # type: () -> LzwDecoder
+        return LzwDecoder(BitReaderLe(io.BytesIO(self.get_data())))
+
+    def get_decoded_data(self): # type: () -> bytes
+        return bytes(self.get_decoder().decode())
+
+    def get_info(self): # type: () -> BpkInfo
+        return sniff_file(self.get_decoder(), self._fname)
+
 
 class LzwReader:
     __slots__ = (
@@ -124,48 +221,837 @@ class LzwReader:
                 #print(f"NEW WIDTH {self._width}")
 
 
-def main(): # type: () -> None
-    for in_fname in sys.argv[1:]:
-        with open(in_fname, "rb") as raw_infp:
-            infp = LzwReader(BitReaderLe(raw_infp))
-            process_file(infp, in_fname)
+class LzwDecoder:
+    """Table-based decoder for the same stream LzwReader handles.
 
+    The dictionary is kept as flat prefix-code/suffix-byte arrays
+    rather than one bytes object per entry,
+    and each code is decoded straight into a single output buffer.
 
-def process_file(infp, in_fname): # type: (LzwReader, str) -> None
-    print(f"Processing {in_fname!r}")
-    outdata_list = [] # type: List[bytes]
+    Each entry also remembers where its string was last written to the output,
+    so most codes are just a slice copy out of the output buffer,
+    with the prefix chain only being walked when that copy has gone.
+
+    It can also be used as a stream with read(), iter_chunks() or decompress_to(),
+    in which case only about window_size bytes of past output are kept.
+
+    If NumPy is available and fp is a BitReaderLe, the first use decodes the whole stream at once
+    with _lzw_decode_numpy() instead, which is several times faster but keeps all of the output.
+    """
+    __slots__ = (
+        "_fp",
+        "_acc",
+        "_nbits",
+        "_width",
+        "_max_width",
+        "_next_code",
+        "_prefix",
+        "_suffix",
+        "_length",
+        "_offset",
+        "_prev_code",
+        "_prev_off",
+        "_prev_len",
+        "_out",
+        "_base",
+        "_start",
+        "_window_size",
+        "_done",
+        "_fresh",
+    )
+
+    def __init__(self, fp, *, window_size=LZW_WINDOW_SIZE): # type: (BitReader, *, int) -> None
+        self._fp = fp # type: BitReader
+        self._max_width = 12 # type: int
+        table_size = 1<<self._max_width # type: int
+
+        # Bits already pulled from fp but not yet used.
+        self._acc = 0 # type: int
+        self._nbits = 0 # type: int
+
+        self._prefix = array("H", bytes(2*table_size)) # type: array[int]
+        self._suffix = array("B", bytes(table_size)) # type: array[int]
+        self._length = array("H", bytes(2*table_size)) # type: array[int]
+        self._offset = array("q", bytes(8*table_size)) # type: array[int]
+
+        for i in range(256):
+            v = i # type: int
+            v = ((v>>3)&0xFF) | (v<<(8-3)&0xFF) # reverse the encraption
+            self._suffix[i] = v
+            self._length[i] = 1
+
+        # Output buffer, the absolute output position of its first byte,
+        # and how much of it has already been returned.
+        self._out = bytearray() # type: bytearray
+        self._base = 0 # type: int
+        self._start = 0 # type: int
+        self._window_size = window_size # type: int
+        self._done = False # type: bool
+        # Nothing read from fp yet, so the NumPy path can still take the whole stream.
+        self._fresh = True # type: bool
+
+        self.reset_tables()
+
+    def reset_tables(self): # type: () -> None
+        self._width = 9 # type: int
+        self._next_code = 0x102 # type: int
+        self._prev_code = -1 # type: int
+        self._prev_off = 0 # type: int
+        self._prev_len = 0 # type: int
+
+    def is_done(self): # type: () -> bool
+        return self._done
+
+    def decode(self, out=None): # type: (Optional[bytearray]) -> bytearray
+        """Decodes the rest of the stream and returns it as one buffer.
+
+        If out is given, the decoded data is appended to it and it is returned.
+        """
+        if out is None:
+            out = bytearray()
+
+        if self._base == 0 and len(self._out) == 0:
+            # Nothing has been decoded yet, so decode directly into the caller's buffer.
+            self._out = out
+            self._base = -len(out)
+            try:
+                self._run(None)
+            finally:
+                self._base += len(out)
+                self._out = bytearray()
+        else:
+            self._run(None)
+            out += memoryview(self._out)[self._start:]
+            self._base += len(self._out)
+            self._start = 0
+            self._out = bytearray()
+
+        return out
+
+    def read(self, size=-1): # type: (int) -> bytes
+        """Decodes and returns up to size more bytes, or b"" at the end of the stream."""
+        if size < 0:
+            return bytes(self.decode())
+
+        self._run(self._start + size)
+        chunk = bytes(self._out[self._start:self._start+size]) # type: bytes
+        self._start += len(chunk)
+        self._trim()
+        return chunk
+
+    def iter_chunks(self, chunk_size=DEFAULT_CHUNK_SIZE): # type: (int) -> Iterator[bytes]
+        """Yields the decoded stream in chunks of chunk_size bytes (the last may be shorter)."""
+        while True:
+            chunk = self.read(chunk_size) # type: bytes
+            if chunk == b"":
+                return
+            yield chunk
+
+    def peek(self, size): # type: (int) -> bytes
+        """Decodes and returns up to size bytes without consuming them."""
+        self._run(self._start + size)
+        return bytes(self._out[self._start:self._start+size])
+
+    def count_remaining(self): # type: () -> int
+        """Consumes the rest of the stream without decoding it, and returns its decoded length.
+
+        Only the code lengths are tracked, so no output is built.
+        """
+        numpy_input = self._take_numpy_input() if self._fresh else None # type: Optional[Tuple[Any, bytes]]
+        if numpy_input is not None:
+            self._done = True
+            return len(self._out) - self._start + _lzw_count_numpy(*numpy_input)
+
+        total = len(self._out) - self._start # type: int
+        self._base += len(self._out)
+        self._start = 0
+        self._out = bytearray()
+
+        length = self._length
+        table_limit = (1<<self._max_width)-1 # type: int
+
+        acc = self._acc
+        nbits = self._nbits
+        width = self._width
+        mask = (1<<width)-1 # type: int
+        next_code = self._next_code
+        prev_len = self._prev_len
+
+        while not self._done:
+            if nbits < width:
+                acc, nbits = self._fill(acc, nbits, width)
+                if nbits < width:
+                    self._done = True
+                    break
+            v = acc & mask # type: int
+            acc >>= width
+            nbits -= width
+
+            if v == 0x100:
+                self._done = True
+                break
+
+            elif v == 0x101:
+                width = 9
+                mask = (1<<width)-1
+                next_code = 0x102
+                prev_len = 0
+                continue
+
+            if v < next_code:
+                n = length[v] # type: int
+            elif v == next_code and prev_len != 0:
+                n = prev_len + 1
+            else:
+                raise ValueError(f"invalid LZW code {v:03X} with table size {next_code:03X}")
+
+            if prev_len != 0 and next_code < table_limit:
+                length[next_code] = prev_len + 1
+                next_code += 1
+                if next_code > mask:
+                    width += 1
+                    mask = (1<<width)-1
+
+            prev_len = n
+            total += n
+
+        self._acc = acc
+        self._nbits = nbits
+        self._width = width
+        self._next_code = next_code
+        self._prev_len = 0
+        self._base += total
+        return total
+
+    def decompress_to(self, fp, chunk_size=DEFAULT_CHUNK_SIZE): # type: (IO[bytes], int) -> int
+        """Writes the rest of the decoded stream to fp and returns how many bytes were written."""
+        total = 0 # type: int
+        for chunk in self.iter_chunks(chunk_size):
+            fp.write(chunk)
+            total += len(chunk)
+        return total
+
+    def _trim(self): # type: () -> None
+        """Drops returned output that is no longer worth keeping."""
+        # The previous code's string always has to stay, it's needed for the next one.
+        cut = min(
+            self._start,
+            len(self._out) - self._window_size,
+            self._prev_off - self._base,
+        ) # type: int
+
+        # Don't bother shuffling tiny amounts around.
+        if cut >= self._window_size:
+            del self._out[:cut]
+            self._base += cut
+            self._start -= cut
+
+    def _take_numpy_input(self): # type: () -> Optional[Tuple[Any, bytes]]
+        """Reads the whole of fp for the NumPy path, or returns None if it can't be used."""
+        self._fresh = False
+        if not isinstance(self._fp, BitReaderLe):
+            return None
+        numpy = _import_numpy() # type: Any
+        if numpy is None:
+            return None
+        data = self._fp.read_rest() # type: Optional[bytes]
+        if data is None:
+            return None
+        return (numpy, data,)
+
+    def _fill(self, acc, nbits, width): # type: (int, int, int) -> Tuple[int, int]
+        """Pulls more bits from fp into the accumulator, as many as it can up to a word."""
+        try:
+            acc |= self._fp.readbits(48) << nbits
+            nbits += 48
+        except EndOfFileReached:
+            # Near the end, so creep up to it.
+            try:
+                while nbits < width:
+                    acc |= self._fp.readbits(1) << nbits
+                    nbits += 1
+            except EndOfFileReached:
+                pass
+        return acc, nbits
+
+    def _run(self, stop): # type: (Optional[int]) -> None
+        """Decodes codes into the output buffer until it holds at least stop bytes."""
+        if self._fresh:
+            numpy_input = self._take_numpy_input() # type: Optional[Tuple[Any, bytes]]
+            if numpy_input is not None:
+                self._out += _lzw_decode_numpy(*numpy_input)
+                self._done = True
+                return
+
+        prefix = self._prefix
+        suffix = self._suffix
+        length = self._length
+        offset = self._offset
+        out = self._out
+        base = self._base
+        table_limit = (1<<self._max_width)-1 # type: int
+        if stop is None:
+            stop = sys.maxsize
+
+        acc = self._acc
+        nbits = self._nbits
+        width = self._width
+        mask = (1<<width)-1 # type: int
+        next_code = self._next_code
+        prev_code = self._prev_code
+        prev_off = self._prev_off
+        prev_len = self._prev_len
+
+        try:
+            while len(out) < stop and not self._done:
+                if nbits < width:
+                    acc, nbits = self._fill(acc, nbits, width)
+                    if nbits < width:
+                        self._done = True
+                        break
+                v = acc & mask # type: int
+                acc >>= width
+                nbits -= width
+
+                if v == 0x100:
+                    # EOF
+                    self._done = True
+                    break
+
+                elif v == 0x101:
+                    # Reset tables
+                    width = 9
+                    mask = (1<<width)-1
+                    next_code = 0x102
+                    prev_code = -1
+                    prev_len = 0
+                    continue
+
+                pos = len(out) # type: int
+
+                if v < 0x100:
+                    out.append(suffix[v])
+                    n = 1 # type: int
+
+                elif v < next_code:
+                    n = length[v]
+                    i = offset[v] - base # type: int
+                    if i >= 0:
+                        out += out[i:i+n]
+                    else:
+                        self._emit_chain(v)
+
+                elif v == next_code and prev_len != 0:
+                    # The code being defined right now: previous string plus its own first byte.
+                    n = prev_len + 1
+                    i = prev_off - base
+                    out += out[i:i+prev_len]
+                    out.append(out[i])
+
+                else:
+                    raise ValueError(f"invalid LZW code {v:03X} with table size {next_code:03X}")
+
+                pos += base
+                if prev_len != 0 and next_code < table_limit:
+                    prefix[next_code] = prev_code
+                    suffix[next_code] = out[pos-base]
+                    length[next_code] = prev_len + 1
+                    offset[next_code] = prev_off
+                    next_code += 1
+                    if next_code > mask:
+                        width += 1
+                        mask = (1<<width)-1
+
+                offset[v] = pos
+                prev_code = v
+                prev_off = pos
+                prev_len = n
+
+        finally:
+            self._acc = acc
+            self._nbits = nbits
+            self._width = width
+            self._next_code = next_code
+            self._prev_code = prev_code
+            self._prev_off = prev_off
+            self._prev_len = prev_len
+
+    def _emit_chain(self, code): # type: (int) -> None
+        """Writes a code's string out by walking its prefix chain backwards."""
+        prefix = self._prefix
+        suffix = self._suffix
+        out = self._out
+        n = self._length[code] # type: int
+        out += bytes(n)
+        i = len(out)-1 # type: int
+        while code >= 0x100:
+            out[i] = suffix[code]
+            code = prefix[code]
+            i -= 1
+        out[i] = suffix[code]
+
+
+def _import_numpy(): # type: () -> Any
     try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _lzw_parse_numpy(numpy, data): # type: (Any, bytes) -> Tuple[Any, Any]
+    """Splits an LZW stream into its data codes, along with where each one's reset segment starts.
+
+    Stops at an EOF code or where the data runs out, like LzwDecoder does.
+    """
+    bits = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8), bitorder="little") # type: Any
+    total_bits = len(bits) # type: int
+    code_blocks = [] # type: List[Any]
+    start_blocks = [] # type: List[Any]
+    code_count = 0 # type: int
+    pos = 0 # type: int
+
+    done = False # type: bool
+    while not done:
+        seg_start = code_count # type: int
+        k = 0 # type: int
         while True:
-            v = infp.getnext() # type: bytes
-            outdata_list.append(v)
-    except EndOfFileReached:
-        pass
+            width, k_end = next(step for step in LZW_WIDTH_STEPS if step[1] is None or k < step[1])
+            want = LZW_NUMPY_BLOCK_CODES if k_end is None else min(LZW_NUMPY_BLOCK_CODES, k_end - k) # type: int
+            m = min(want, (total_bits - pos) // width) # type: int
+            if m == 0:
+                done = True
+                break
+
+            weights = numpy.left_shift(1, numpy.arange(width, dtype=numpy.int64)) # type: Any
+            block = bits[pos:pos+m*width].reshape(m, width) @ weights # type: Any
+            controls = numpy.flatnonzero((block == 0x100) | (block == 0x101)) # type: Any
+            control = None # type: Optional[int]
+            if len(controls) > 0:
+                c = int(controls[0]) # type: int
+                control = int(block[c])
+                block = block[:c]
+                pos += (c+1)*width
+            else:
+                pos += m*width
+
+            code_blocks.append(block)
+            start_blocks.append(numpy.full(len(block), seg_start, dtype=numpy.int64))
+            code_count += len(block)
+            k += len(block)
+            if control == 0x100 or (control is None and m < want):
+                done = True
+                break
+            elif control == 0x101:
+                break
+
+    if code_blocks == []:
+        return (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64),)
+    return (numpy.concatenate(code_blocks), numpy.concatenate(start_blocks),)
+
+
+def _lzw_lengths_numpy(numpy, codes, seg_starts): # type: (Any, Any, Any) -> Tuple[Any, Any, Any]
+    """Works out each code's string length, and which earlier code's string it copies.
+
+    Every string is the string of an earlier code plus one more byte,
+    so the lengths are found by following those links back to a single byte, doubling up each time.
+    Returns the lengths, the earlier code of each (or itself for single bytes), and which codes are single bytes.
+    """
+    n = len(codes) # type: int
+    idx = numpy.arange(n, dtype=numpy.int64) # type: Any
+    k = idx - seg_starts # type: Any
+    next_code = numpy.where(k == 0, 0x102, numpy.minimum(0x101 + k, LZW_TABLE_LIMIT)) # type: Any
+    literal = codes < 0x100 # type: Any
+
+    bad = ~literal & ((k == 0) | (codes > next_code)) # type: Any
+    if bad.any():
+        i = int(numpy.argmax(bad)) # type: int
+        raise ValueError(f"invalid LZW code {int(codes[i]):03X} with table size {int(next_code[i]):03X}")
+
+    # The code being defined right now copies the one just before it.
+    ref = numpy.where(literal, idx, numpy.where(codes == next_code, idx - 1, seg_starts + codes - 0x102)) # type: Any
+
+    depth = (~literal).astype(numpy.int64) # type: Any
+    parent = ref # type: Any
+    while True:
+        grandparent = parent[parent] # type: Any
+        if numpy.array_equal(grandparent, parent):
+            break
+        depth = depth + depth[parent]
+        parent = grandparent
+
+    return (depth + 1, ref, literal,)
+
+
+def _lzw_decode_numpy(numpy, data): # type: (Any, bytes) -> bytes
+    """Decodes a whole LZW stream at once.
+
+    Each code's string is a copy of an earlier one's plus its own first byte,
+    so every output byte is a copy of some earlier byte, or a literal.
+    Those copies are followed back to the literals by doubling up, the same way as the lengths.
+    """
+    codes, seg_starts = _lzw_parse_numpy(numpy, data)
+    if len(codes) == 0:
+        return b""
+    lengths, ref, literal = _lzw_lengths_numpy(numpy, codes, seg_starts)
+
+    ends = numpy.cumsum(lengths) # type: Any
+    starts = ends - lengths # type: Any
+    total = int(ends[-1]) # type: int
+    owner = numpy.repeat(numpy.arange(len(codes), dtype=numpy.int64), lengths) # type: Any
+    out_pos = numpy.arange(total, dtype=numpy.int64) # type: Any
+    src = numpy.where(literal[owner], out_pos, starts[ref][owner] + (out_pos - starts[owner])) # type: Any
+    while True:
+        next_src = src[src] # type: Any
+        if numpy.array_equal(next_src, src):
+            break
+        src = next_src
+
+    decode_map = numpy.frombuffer(LZW_DECODE_MAP, dtype=numpy.uint8) # type: Any
+    return decode_map[codes[owner[src]]].tobytes()
+
+
+def _lzw_count_numpy(numpy, data): # type: (Any, bytes) -> int
+    """Like len(_lzw_decode_numpy(numpy, data)), without building the output."""
+    codes, seg_starts = _lzw_parse_numpy(numpy, data)
+    if len(codes) == 0:
+        return 0
+    return int(_lzw_lengths_numpy(numpy, codes, seg_starts)[0].sum())
+
+
+class LzwEncoder:
+    """Encoder for the stream LzwReader and LzwDecoder read.
+
+    The dictionary is a dict keyed on prefix code and next byte packed into one int.
+    Once it fills up, a reset code is sent and it starts again from scratch.
+    Codes are collected in a list and handed to the bit writer in runs of the same width.
+    """
+    __slots__ = (
+        "_fp",
+        "_max_width",
+        "_table",
+        "_next_code",
+        "_prev_code",
+        "_codes",
+        "_index",
+        "_closed",
+    )
+
+    def __init__(self, fp): # type: (BitWriter) -> None
+        self._fp = fp # type: BitWriter
+        self._max_width = 12 # type: int
+        self._table = {} # type: Dict[int, int]
+        self._codes = [] # type: List[int]
+        self._closed = False # type: bool
+
+        # Codes written since the last reset, which decides the width the decoder expects.
+        self._index = 0 # type: int
+
+        self.reset_tables()
+
+    def __enter__(self): # type: () -> LzwEncoder
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback): # type: (object, object, object) -> None
+        if exc_type is None:
+            self.close()
+
+    def reset_tables(self): # type: () -> None
+        self._table.clear()
+        self._next_code = 0x102 # type: int
+        self._prev_code = -1 # type: int
+
+    def write(self, data): # type: (Union[bytes, bytearray, memoryview]) -> None
+        assert not self._closed
+        data = bytes(data).translate(LZW_ENCODE_MAP)
+        if data == b"":
+            return
+
+        table = self._table
+        table_get = table.get
+        codes = self._codes
+        next_code = self._next_code
+        max_code = (1<<self._max_width)-1 # type: int
+        w = self._prev_code # type: int
+        if w < 0:
+            w = data[0]
+            data = data[1:]
+
+        for c in data:
+            k = (w<<8)|c # type: int
+            nw = table_get(k) # type: Optional[int]
+            if nw is not None:
+                w = nw
+                continue
+
+            codes.append(w)
+            if next_code < max_code:
+                table[k] = next_code
+                next_code += 1
+            else:
+                codes.append(0x101)
+                self._put_codes()
+                table.clear()
+                next_code = 0x102
+            w = c
+
+            if len(codes) >= DEFAULT_CHUNK_SIZE:
+                self._put_codes()
+
+        self._next_code = next_code
+        self._prev_code = w
+
+    def close(self): # type: () -> None
+        """Ends the stream and flushes the bit writer. The file object itself is left open."""
+        if self._closed:
+            return
+
+        if self._prev_code >= 0:
+            self._codes.append(self._prev_code)
+        self._codes.append(0x100)
+        self._put_codes()
+        self._fp.flush()
+        self._closed = True
+
+    def _put_codes(self): # type: () -> None
+        """Writes out the pending codes at the widths the decoder will read them at."""
+        codes = self._codes
+        index = self._index
+        pos = 0 # type: int
+        while pos < len(codes):
+            # The decoder adds an entry for every code but the first after a reset,
+            # and widens once its next entry no longer fits.
+            table_size = min(0x101 + max(1, index), (1<<self._max_width)-1) # type: int
+            width = max(9, table_size.bit_length()) # type: int
+            if width < self._max_width:
+                run = ((1<<width) - 0x101) - index # type: int
+            else:
+                run = len(codes) - pos
+
+            run_codes = codes[pos:pos+run] # type: List[int]
+            if 0x101 in run_codes:
+                # Everything after a reset starts again at the narrowest width.
+                run_codes = run_codes[:run_codes.index(0x101)+1]
+                self._fp.writebits_many(run_codes, width)
+                pos += len(run_codes)
+                index = 0
+                continue
+
+            self._fp.writebits_many(run_codes, width)
+            pos += len(run_codes)
+            index += len(run_codes)
+
+        self._index = index
+        codes.clear()
+
 
-    outdata = b"".join(outdata_list) # type: bytes
-    ensure_dirs(OUT_ROOT_DIR)
+def compress(data): # type: (Union[bytes, bytearray, memoryview]) -> bytes
+    """Compresses data into a complete BPK stream."""
+    outfp = io.BytesIO() # type: io.BytesIO
+    with LzwEncoder(BitWriterLe(outfp)) as encoder:
+        encoder.write(data)
+    return outfp.getvalue()
+
+
+def compress_file_name(in_fname, out_fname): # type: (str, str) -> None
+    with open(in_fname, "rb") as infp:
+        with open(out_fname, "wb") as outfp:
+            with LzwEncoder(BitWriterLe(outfp)) as encoder:
+                while True:
+                    data = infp.read(DEFAULT_CHUNK_SIZE) # type: bytes
+                    if data == b"":
+                        break
+                    encoder.write(data)
+
+
+def main(): # type: () -> None
+    run(sys.argv[1:])
+
+
+def run(args): # type: (List[str]) -> None
+    """Does what main() does, for args instead of the command line: leading options, then the files."""
+    disk_cache = get_default_disk_cache() # type: Optional[DiskCache]
+    in_fnames = list(args) # type: List[str]
+    output_spec = "." # type: str
+    pipelined = False # type: bool
+    image_formats = DEFAULT_IMAGE_FORMATS # type: Tuple[str, ...]
+    while in_fnames[:1] in (["-o"], ["--pipeline"], ["--png"]):
+        if in_fnames[0] == "--pipeline":
+            pipelined = True
+            in_fnames = in_fnames[1:]
+        elif in_fnames[0] == "--png":
+            image_formats = (IMAGE_FORMAT_TGA, IMAGE_FORMAT_PNG,)
+            in_fnames = in_fnames[1:]
+        else:
+            if len(in_fnames) < 2:
+                raise SystemExit(OUTPUT_OPTION_USAGE)
+            output_spec = in_fnames[1]
+            in_fnames = in_fnames[2:]
+
+    with open_output(output_spec) as output:
+        with progress_to_stderr(output):
+            if pipelined:
+                process_files_pipelined(in_fnames, disk_cache=disk_cache, output=output, image_formats=image_formats)
+                return
+
+            for in_fname in in_fnames:
+                if disk_cache is not None:
+                    process_file_cached(in_fname, disk_cache, output=output, image_formats=image_formats)
+                    continue
+
+                with open(in_fname, "rb") as raw_infp:
+                    infp = LzwDecoder(BitReaderLe(raw_infp))
+                    process_file(infp, in_fname, output=output, image_formats=image_formats)
+
+
+def process_file_cached(in_fname, disk_cache, *, output=None, image_formats=DEFAULT_IMAGE_FORMATS): # type: (str, DiskCache, *, Optional[OutputBackend], Tuple[str, ...]) -> None
+    """Like process_file, but takes the decoded data from disk_cache if it's there, or adds it if not."""
+    with open(in_fname, "rb") as raw_infp:
+        raw_data = raw_infp.read() # type: bytes
+    key = DiskCache.make_key("bpk.lzw", LZW_DECODER_VERSION, raw_data) # type: str
+
+    cached_fp = disk_cache.open(key)
+    if cached_fp is not None:
+        with cached_fp:
+            process_chunks(iter(lambda: cached_fp.read(DEFAULT_CHUNK_SIZE), b""), in_fname, output=output, image_formats=image_formats)
+        return
+
+    infp = LzwDecoder(BitReaderLe(io.BytesIO(raw_data)))
+    with disk_cache.writer(key) as cache_fp:
+        process_chunks(_tee_chunks(infp.iter_chunks(), cache_fp), in_fname, output=output, image_formats=image_formats)
+
+
+def process_files_pipelined(in_fnames, *, disk_cache=None, output=None, max_workers=None, image_formats=DEFAULT_IMAGE_FORMATS): # type: (List[str], *, Optional[DiskCache], Optional[OutputBackend], Optional[int], Tuple[str, ...]) -> None
+    """Like process_file for each file, but reading, decoding and writing all at once.
+
+    Decoding is done in worker processes.
+    """
+    if output is None:
+        output = DirectoryOutput()
+
+    def read(in_fname): # type: (str) -> Tuple[bytes, Optional[bytes]]
+        with open(in_fname, "rb") as raw_infp:
+            raw_data = raw_infp.read() # type: bytes
+        cached_data = None # type: Optional[bytes]
+        if disk_cache is not None:
+            cached_data = disk_cache.get(DiskCache.make_key("bpk.lzw", LZW_DECODER_VERSION, raw_data))
+        return (raw_data, cached_data,)
+
+    def write(in_fname, decoded): # type: (str, Tuple[bytes, Optional[bytes], bool]) -> None
+        raw_data, data, was_cached = decoded
+        assert data is not None
+        if disk_cache is not None and not was_cached:
+            disk_cache.put(DiskCache.make_key("bpk.lzw", LZW_DECODER_VERSION, raw_data), data)
+        process_chunks([data], in_fname, output=output, image_formats=image_formats)
+
+    run_pipeline(
+        in_fnames,
+        read=read,
+        decode=_decode_for_pipeline,
+        write=write,
+        max_workers=max_workers,
+    )
+
+
+def _decode_for_pipeline(in_fname, read_data): # type: (str, Tuple[bytes, Optional[bytes]]) -> Tuple[bytes, Optional[bytes], bool]
+    raw_data, cached_data = read_data
+    if cached_data is not None:
+        return (raw_data, cached_data, True,)
+    return (raw_data, bytes(LzwDecoder(BitReaderLe(io.BytesIO(raw_data))).decode()), False,)
+
+
+def _tee_chunks(chunks, fp): # type: (Iterable[bytes], IO[bytes]) -> Iterator[bytes]
+    for chunk in chunks:
+        fp.write(chunk)
+        yield chunk
+
+
+def is_rix3(header, in_fname): # type: (bytes, str) -> bool
+    file_format = detect_format(in_fname, header, None, inside=FORMAT_BPK) # type: Optional[FileFormat]
+    return file_format is not None and file_format.name == FORMAT_RIX3
+
+
+def identify(header, length, in_fname): # type: (bytes, Optional[int], str) -> BpkInfo
+    """Works out the image type from the start of a decoded file and possibly its length."""
+    if is_rix3(header, in_fname):
+        w, h, = struct.unpack("<HH", header[0x4:][:0x4]) # type: Tuple[int, int]
+        return BpkInfo(kind=BPK_KIND_RIX3, width=w, height=h, pal_fname=None, length=length)
+
+    elif length in TGA_SIZE_PAL_MAPS:
+        w, h, pal_fname = TGA_SIZE_PAL_MAPS[length]
+        if pal_fname is None:
+            pal_fname = in_fname.rpartition(".")[0] + ".PAL"
+        return BpkInfo(kind=BPK_KIND_SIZE_MAP, width=w, height=h, pal_fname=pal_fname, length=length)
+
+    else:
+        return BpkInfo(kind=BPK_KIND_RAW, width=0, height=0, pal_fname=None, length=length)
+
+
+def sniff_file(infp, in_fname): # type: (LzwDecoder, str) -> BpkInfo
+    """Identifies a BPK file while decoding as little of it as possible.
+
+    RIX3 files only need their header decoded.
+    Anything else needs its length, which is counted without building the output.
+    This consumes the decoder.
+    """
+    header = infp.peek(BPK_SNIFF_SIZE) # type: bytes
+    if is_rix3(header, in_fname):
+        return identify(header, None, in_fname)
+    else:
+        return identify(header, infp.count_remaining(), in_fname)
+
+
+def sniff_file_name(in_fname): # type: (str) -> BpkInfo
+    with open(in_fname, "rb") as raw_infp:
+        return sniff_file(LzwDecoder(BitReaderLe(raw_infp)), in_fname)
+
+
+def process_file(infp, in_fname, *, output=None, image_formats=DEFAULT_IMAGE_FORMATS): # type: (LzwDecoder, str, *, Optional[OutputBackend], Tuple[str, ...]) -> None
+    process_chunks(infp.iter_chunks(), in_fname, output=output, image_formats=image_formats)
+
+
+def process_chunks(chunks, in_fname, *, output=None, image_formats=DEFAULT_IMAGE_FORMATS): # type: (Iterable[bytes], str, *, Optional[OutputBackend], Tuple[str, ...]) -> None
+    """Writes out a decoded file, and images in each of image_formats if it's recognisable as one."""
+    print(f"Processing {in_fname!r}")
+    if output is None:
+        output = DirectoryOutput()
     out_fname = os.path.join(*[OUT_ROOT_DIR, in_fname+".unlzw"])
-    print(len(outdata))
-    with open(out_fname, "wb") as outfp:
-        outfp.write(outdata)
 
-    w, h, = (0, 0,) # type: Tuple[int, int]
+    # Stream the output, only holding onto all of it while it could still be an image.
+    header = bytearray() # type: bytearray
+    kept = bytearray() # type: bytearray
+    keep = True # type: bool
+    outlen = 0 # type: int
+    with output.open_file(out_fname) as outfp:
+        for chunk in chunks:
+            if len(header) < RIX3_HEADER_SIZE:
+                header += chunk[:RIX3_HEADER_SIZE-len(header)]
+            outfp.write(chunk)
+            outlen += len(chunk)
+            if keep:
+                kept += chunk
+                if outlen > TGA_MAX_SIZE_MAP_LENGTH and not is_rix3(bytes(header), in_fname):
+                    keep = False
+                    kept = bytearray()
+    print(outlen)
+
+    info = identify(bytes(header), outlen, in_fname) # type: BpkInfo
+    w, h, = (info.width, info.height,) # type: Tuple[int, int]
     has_dims = False
     paldata = b"" # type: bytes
-    if outdata[:4] == b"RIX3":
-        w, h, unk1 = struct.unpack("<HHH", outdata[0x4:][:0x6])
+    pixel_offset = 0 # type: int
+    if info.kind == BPK_KIND_RIX3:
+        unk1, = struct.unpack("<H", header[0x8:][:0x2]) # type: Tuple[int]
         print(f"RIX3 file detected, {w} x {h} (unk {unk1} / {unk1:04X})")
-        paldata = outdata[0xA:][:256*3]
+        paldata = bytes(header[0xA:][:256*3])
         assert len(paldata) == 256*3
-        outdata = outdata[0x30A:]
+        pixel_offset = RIX3_HEADER_SIZE
         has_dims = True
 
-    elif len(outdata) in TGA_SIZE_PAL_MAPS:
-        w, h, pal_fname = TGA_SIZE_PAL_MAPS[len(outdata)]
+    elif info.kind == BPK_KIND_SIZE_MAP:
         has_dims = True
-        if pal_fname is None:
-            in_pal_fname = in_fname.rpartition(".")[0] + ".PAL"
-        else:
-            in_pal_fname = pal_fname
+        in_pal_fname = info.pal_fname # type: Optional[str]
+        assert in_pal_fname is not None
 
         try:
             with open(in_pal_fname, "rb") as inpalfp:
@@ -177,21 +1063,24 @@ def process_file(infp, in_fname): # type: (LzwReader, str) -> None
             assert len(paldata) == 256*3
 
     if has_dims and paldata != b"":
-        tga_out_fname = os.path.join(*[OUT_ROOT_DIR, in_fname+".tga"])
-        print(f"Writing {tga_out_fname!r}")
-        assert w*h == len(outdata)
-        with open(tga_out_fname, "wb") as outfp:
-            outfp.write(struct.pack("<BBB", 0, 1, 1))
-            outfp.write(struct.pack("<HHB", 0, 256, 24))
-            outfp.write(struct.pack("<HHHH", 0, 0, w, h))
-            outfp.write(struct.pack("<BB", 8, 0b00100000))
-            for i in range(256):
-                outfp.write(bytes([(paldata[i*3+2]*0x41)>>4]))
-                outfp.write(bytes([(paldata[i*3+1]*0x41)>>4]))
-                outfp.write(bytes([(paldata[i*3+0]*0x41)>>4]))
-            outfp.write(outdata)
+        assert w*h == outlen - pixel_offset
+        assert keep
+        image = IndexedImage.from_vga(
+            width=w,
+            height=h,
+            palette=paldata,
+            pixels=memoryview(kept)[pixel_offset:],
+        )
+        for image_format in image_formats:
+            image_out_fname = os.path.join(*[OUT_ROOT_DIR, in_fname+"."+image_format])
+            print(f"Writing {image_out_fname!r}")
+            if image_format == IMAGE_FORMAT_TGA:
+                output.write_file(image_out_fname, image.encode_tga())
+            elif image_format == IMAGE_FORMAT_PNG:
+                output.write_file(image_out_fname, image.encode_png())
+            else:
+                raise ValueError(f"unknown image format {image_format!r}")
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3 --
+# vim: set sts=4 sw=4 et :
+
+import sys
+
+from sgtools.game.deathrally.bpk import compress_file_name
+
+
+def main(): # type: () -> None
+    in_fname = sys.argv[1] # type: str
+    out_fname = sys.argv[2] # type: str
+    print(f"Compressing {in_fname} to {out_fname}")
+    compress_file_name(in_fname, out_fname)
+
+
+if __name__ == "__main__":
+    main()
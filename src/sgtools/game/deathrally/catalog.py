@@ -0,0 +1,223 @@
+#!/usr/bin/env python3 --
+# vim: set sts=4 sw=4 et :
+
+import hashlib
+import io
+import os
+import os.path
+import sqlite3
+import sys
+
+try:
+    from typing import TYPE_CHECKING
+except ImportError:
+    TYPE_CHECKING = False
+else:
+    from typing import List
+    from typing import Optional
+    from typing import Tuple
+
+from sgtools.base.io import BitReaderLe
+from sgtools.game.deathrally.bpa import BpaFatEntry
+from sgtools.game.deathrally.bpa import BpaReader
+from sgtools.game.deathrally.bpk import LzwDecoder
+from sgtools.game.deathrally.bpk import sniff_file
+from sgtools.game.deathrally.core import BPA_ARCHIVES
+from sgtools.game.deathrally.core import CMF_HEADER_SIZE
+from sgtools.game.deathrally.core import DeathRallyCmfFile
+from sgtools.game.deathrally.formats import FORMAT_BPK
+from sgtools.game.deathrally.formats import FORMAT_CMF
+from sgtools.game.deathrally.formats import FileFormat
+from sgtools.game.deathrally.formats import SNIFF_WINDOW_SIZE
+from sgtools.game.deathrally.formats import detect_format
+
+DEFAULT_CATALOG_FNAME = "catalog.sqlite" # type: str
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    archive TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS members (
+    archive TEXT NOT NULL REFERENCES archives(archive) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    kind TEXT,
+    width INTEGER,
+    height INTEGER,
+    PRIMARY KEY (archive, idx)
+);
+CREATE INDEX IF NOT EXISTS members_name ON members (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS members_sha256 ON members (sha256);
+""" # type: str
+
+
+class CatalogMember:
+    """One row of the catalog."""
+    __slots__ = (
+        "archive",
+        "name",
+        "offset",
+        "size",
+        "sha256",
+        "kind",
+        "width",
+        "height",
+    )
+
+    def __init__(self, *, archive, name, offset, size, sha256, kind, width, height): # type: (*, str, str, int, int, str, Optional[str], Optional[int], Optional[int]) -> None
+        self.archive = archive # type: str
+        self.name = name # type: str
+        self.offset = offset # type: int
+        self.size = size # type: int
+        self.sha256 = sha256 # type: str
+        self.kind = kind # type: Optional[str]
+        self.width = width # type: Optional[int]
+        self.height = height # type: Optional[int]
+
+    def __repr__(self): # type: () -> str
+        return f"CatalogMember(archive={self.archive!r}, name={self.name!r}, offset={self.offset!r}, size={self.size!r}, kind={self.kind!r})"
+
+
+class Catalog:
+    """A SQLite index of every file in every archive of a game directory.
+
+    refresh() only rescans archives whose size or mtime has changed since they were last indexed.
+    """
+    __slots__ = (
+        "_game_dir",
+        "_conn",
+    )
+
+    def __init__(self, db_fname, *, game_dir="."): # type: (str, *, str) -> None
+        self._game_dir = game_dir # type: str
+        self._conn = sqlite3.connect(db_fname) # type: sqlite3.Connection
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._conn.executescript(CATALOG_SCHEMA)
+
+    def __enter__(self): # type: () -> Catalog
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback): # type: (object, object, object) -> None
+        self.close()
+
+    def close(self): # type: () -> None
+        self._conn.close()
+
+    def refresh(self): # type: () -> List[str]
+        """Brings the catalog up to date, returning the names of the archives that were rescanned."""
+        rescanned = [] # type: List[str]
+        with self._conn:
+            for archive in BPA_ARCHIVES:
+                path = os.path.join(*[self._game_dir, archive])
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    self._conn.execute("DELETE FROM archives WHERE archive = ?", (archive,))
+                    continue
+
+                row = self._conn.execute(
+                    "SELECT size, mtime_ns FROM archives WHERE archive = ?",
+                    (archive,),
+                ).fetchone() # type: Optional[Tuple[int, int]]
+                if row == (st.st_size, st.st_mtime_ns):
+                    continue
+
+                self._scan_archive(archive, path, st.st_size, st.st_mtime_ns)
+                rescanned.append(archive)
+
+        return rescanned
+
+    def _scan_archive(self, archive, path, size, mtime_ns): # type: (str, str, int, int) -> None
+        self._conn.execute("DELETE FROM archives WHERE archive = ?", (archive,))
+        self._conn.execute(
+            "INSERT INTO archives (archive, size, mtime_ns) VALUES (?, ?, ?)",
+            (archive, size, mtime_ns,),
+        )
+
+        with open(path, "rb") as fp:
+            bpa_reader = BpaReader(
+                fname=archive,
+                fp=fp,
+                lazy=True,
+            )
+            for idx, fat_entry in enumerate(bpa_reader.each_fat_entry()):
+                data = fat_entry.get_data()
+                kind, width, height = _detect_kind(fat_entry, data)
+                self._conn.execute(
+                    "INSERT INTO members (archive, idx, name, offset, size, sha256, kind, width, height) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (archive, idx, fat_entry.fname, fat_entry.offset, fat_entry.size, hashlib.sha256(data).hexdigest(), kind, width, height,),
+                )
+
+    def _query(self, where, params): # type: (str, Tuple[object, ...]) -> List[CatalogMember]
+        rows = self._conn.execute(
+            "SELECT archive, name, offset, size, sha256, kind, width, height FROM members"
+            + " WHERE " + where + " ORDER BY archive, idx",
+            params,
+        ).fetchall()
+        return [
+            CatalogMember(
+                archive=archive,
+                name=name,
+                offset=offset,
+                size=size,
+                sha256=sha256,
+                kind=kind,
+                width=width,
+                height=height,
+            )
+            for (archive, name, offset, size, sha256, kind, width, height,) in rows
+        ]
+
+    def lookup(self, name): # type: (str) -> List[CatalogMember]
+        """Finds every file with the given name, ignoring case."""
+        return self._query("name = ? COLLATE NOCASE", (name,))
+
+    def search(self, pattern): # type: (str) -> List[CatalogMember]
+        """Finds every file whose "ARCHIVE/NAME" path matches a glob, ignoring case."""
+        # GLOB is fnmatch's syntax, except for negated sets: [!...] there is [^...] here.
+        pattern = pattern.upper().replace("[!", "[^")
+        return self._query("upper(archive || '/' || name) GLOB ?", (pattern,))
+
+    def find_by_hash(self, sha256): # type: (str) -> List[CatalogMember]
+        return self._query("sha256 = ?", (sha256,))
+
+
+def _detect_kind(fat_entry, data): # type: (BpaFatEntry, bytes) -> Tuple[Optional[str], Optional[int], Optional[int]]
+    """Works out the kind of file, and its dimensions if it's an image."""
+    file_format = detect_format(fat_entry.fname, bytes(data[:SNIFF_WINDOW_SIZE]), len(data)) # type: Optional[FileFormat]
+    if file_format is None:
+        return (None, None, None,)
+
+    elif file_format.name == FORMAT_CMF:
+        header = DeathRallyCmfFile._unobfuscate_data(data[:CMF_HEADER_SIZE]) # type: bytes
+        heuristic = DeathRallyCmfFile.get_heuristic(header) # type: List[str]
+        if len(heuristic) == 1:
+            return (heuristic[0], None, None,)
+        return ("CMF", None, None,)
+
+    elif file_format.name == FORMAT_BPK:
+        try:
+            info = sniff_file(LzwDecoder(BitReaderLe(io.BytesIO(data))), fat_entry.fname)
+        except ValueError:
+            return ("BPK", None, None,) # not an LZW stream we understand
+        return (f"BPK:{info.kind}", info.width, info.height,)
+
+    else:
+        return (file_format.name.upper(), None, None,)
+
+
+def main(): # type: () -> None
+    db_fname = sys.argv[1] if len(sys.argv) >= 2 else DEFAULT_CATALOG_FNAME # type: str
+    game_dir = sys.argv[2] if len(sys.argv) >= 3 else "." # type: str
+    with Catalog(db_fname, game_dir=game_dir) as catalog:
+        for archive in catalog.refresh():
+            print(f"Indexed {archive}")
+
+
+if __name__ == "__main__":
+    main()
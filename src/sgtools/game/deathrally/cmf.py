@@ -10,37 +10,234 @@ try:
 except ImportError:
     TYPE_CHECKING = False
 else:
+    from typing import Any
     from typing import Iterable
     from typing import IO
     from typing import List
+    from typing import Optional
     from typing import Tuple
+    from typing import Union
 
-from sgtools.base.utils import ensure_dirs
+from sgtools.base.diskcache import DiskCache
+from sgtools.base.diskcache import get_default_disk_cache
+from sgtools.base.output import DirectoryOutput
+from sgtools.base.output import OutputBackend
+from sgtools.base.output import OUTPUT_OPTION_USAGE
+from sgtools.base.output import open_output
+from sgtools.base.output import progress_to_stderr
+from sgtools.base.pipeline import run_pipeline
+from sgtools.game.deathrally.formats import FORMAT_CMF
+from sgtools.game.deathrally.formats import FileFormat
+from sgtools.game.deathrally.formats import SNIFF_WINDOW_SIZE
+from sgtools.game.deathrally.formats import detect_format
 
 OUT_DIR = os.path.join(*["uncmf"]) # type: str
 
+# Bump this whenever a change to the unobfuscation could change its output, to invalidate cached results.
+CMF_DECODER_VERSION = 1 # type: int
+
+# How many bytes the NumPy path works on at once, to keep its temporaries small.
+NUMPY_BLOCK_SIZE = 1<<20 # type: int
+
+# Lazily-built translation tables for the non-NumPy path:
+# one rotate-left table per (pos % 7), and one subtract table per (pos % 256).
+_rotate_tables = None # type: Optional[List[bytes]]
+_subtract_tables = None # type: Optional[List[bytes]]
+
+
+def unobfuscate_data(data, *, start=0): # type: (Union[bytearray, memoryview], *, int) -> None
+    """Unobfuscates an obfuscated music/sound file in place.
+
+    start is the position in the file of the first byte of data,
+    so a file can be unobfuscated in pieces.
+    """
+    numpy = _import_numpy() # type: Any
+    if numpy is not None:
+        _unobfuscate_numpy(numpy, data, start=start)
+    else:
+        _unobfuscate_tables(data, start=start)
+
+
+def obfuscate_data(data, *, start=0): # type: (Union[bytearray, memoryview], *, int) -> None
+    """Obfuscates a music/sound file in place, undoing unobfuscate_data."""
+    numpy = _import_numpy() # type: Any
+    if numpy is not None:
+        _obfuscate_numpy(numpy, data, start=start)
+    else:
+        _obfuscate_tables(data, start=start)
+
+
+def _import_numpy(): # type: () -> Any
+    # Imported here rather than at the top, so the subcommands that never touch CMF data don't pay for it.
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _unobfuscate_numpy(numpy, data, *, start): # type: (Any, Union[bytearray, memoryview], *, int) -> None
+    wdata = numpy.frombuffer(data, dtype=numpy.uint8)
+    for block_start in range(0, len(wdata), NUMPY_BLOCK_SIZE):
+        block = wdata[block_start:block_start+NUMPY_BLOCK_SIZE]
+        pos = numpy.arange(start+block_start, start+block_start+len(block), dtype=numpy.int64)
+        rot = (pos % 7).astype(numpy.uint8)
+        sub = ((0x6D + (pos*0x11)) & 0xFF).astype(numpy.uint8)
+        block[:] = ((block << rot) | (block >> (8 - rot))) - sub
+
+
+def _obfuscate_numpy(numpy, data, *, start): # type: (Any, Union[bytearray, memoryview], *, int) -> None
+    wdata = numpy.frombuffer(data, dtype=numpy.uint8)
+    for block_start in range(0, len(wdata), NUMPY_BLOCK_SIZE):
+        block = wdata[block_start:block_start+NUMPY_BLOCK_SIZE]
+        pos = numpy.arange(start+block_start, start+block_start+len(block), dtype=numpy.int64)
+        rot = (pos % 7).astype(numpy.uint8)
+        add = ((0x6D + (pos*0x11)) & 0xFF).astype(numpy.uint8)
+        block += add
+        block[:] = (block >> rot) | (block << (8 - rot))
+
+
+def _get_tables(): # type: () -> Tuple[List[bytes], List[bytes]]
+    global _rotate_tables
+    global _subtract_tables
+
+    if _rotate_tables is None or _subtract_tables is None:
+        _rotate_tables = [
+            bytes([((v<<r)|(v>>(8-r))) & 0xFF for v in range(256)])
+            for r in range(7)
+        ]
+        _subtract_tables = [
+            bytes([(v - (0x6D + (p*0x11))) & 0xFF for v in range(256)])
+            for p in range(256)
+        ]
+
+    return (_rotate_tables, _subtract_tables,)
+
+
+def _obfuscate_tables(data, *, start): # type: (Union[bytearray, memoryview], *, int) -> None
+    rotate_tables, subtract_tables = _get_tables()
+
+    # Same as unobfuscating, but backwards, with every table inverted.
+    identity = bytes(range(256)) # type: bytes
+    wdata = memoryview(data)
+    for p in range(256):
+        i = (p - start) % 256 # type: int
+        wdata[i::256] = wdata[i::256].tobytes().translate(bytes.maketrans(subtract_tables[p], identity))
+    for r in range(7):
+        i = (r - start) % 7
+        wdata[i::7] = wdata[i::7].tobytes().translate(bytes.maketrans(rotate_tables[r], identity))
+
+
+def _unobfuscate_tables(data, *, start): # type: (Union[bytearray, memoryview], *, int) -> None
+    rotate_tables, subtract_tables = _get_tables()
+
+    # Every byte sharing a position modulo the period gets the same treatment,
+    # so each of those strided slices can go through one translate() call.
+    wdata = memoryview(data)
+    for r in range(7):
+        i = (r - start) % 7 # type: int
+        wdata[i::7] = wdata[i::7].tobytes().translate(rotate_tables[r])
+    for p in range(256):
+        i = (p - start) % 256
+        wdata[i::256] = wdata[i::256].tobytes().translate(subtract_tables[p])
+
+
 def main(): # type: () -> None
-    for fname in sys.argv[1:]:
-        process_cmf(fname)
+    run(sys.argv[1:])
 
-def process_cmf(cmf_fname): # type: (str) -> None
+
+def run(args): # type: (List[str]) -> None
+    """Does what main() does, for args instead of the command line: leading options, then the files."""
+    disk_cache = get_default_disk_cache() # type: Optional[DiskCache]
+    fnames = list(args) # type: List[str]
+    output_spec = "." # type: str
+    pipelined = False # type: bool
+    while fnames[:1] in (["-o"], ["--pipeline"]):
+        if fnames[0] == "--pipeline":
+            pipelined = True
+            fnames = fnames[1:]
+        else:
+            if len(fnames) < 2:
+                raise SystemExit(OUTPUT_OPTION_USAGE)
+            output_spec = fnames[1]
+            fnames = fnames[2:]
+
+    with open_output(output_spec) as output:
+        with progress_to_stderr(output):
+            if pipelined:
+                process_cmfs_pipelined(fnames, disk_cache=disk_cache, output=output)
+                return
+
+            for fname in fnames:
+                process_cmf(fname, disk_cache=disk_cache, output=output)
+
+def process_cmf(cmf_fname, *, disk_cache=None, output=None): # type: (str, *, Optional[DiskCache], Optional[OutputBackend]) -> None
     print(f"Processing {cmf_fname!r}")
-    ensure_dirs(OUT_DIR)
+    if output is None:
+        output = DirectoryOutput()
     data = bytearray(open(cmf_fname, "rb").read())
-    for pos in range(len(data)):
-        v = data[pos]
-        v = (((v<<(pos%7))|(v>>(8-(pos%7)))) - (0x6D + (pos*0x11))) & 0xFF
-        data[pos] = v
-
-    if data[0x2C:0x2C+0x4] == b"SCRM":
-        out_fname = os.path.join(*[OUT_DIR, cmf_fname + ".s3m"])
-    elif data[0x00:0x00+0x11] == b"Extended Module: ":
-        out_fname = os.path.join(*[OUT_DIR, cmf_fname + ".xm"])
+
+    if disk_cache is None:
+        unobfuscate_data(data)
     else:
-        out_fname = os.path.join(*[OUT_DIR, cmf_fname + ".unknown"])
+        key = DiskCache.make_key("cmf", CMF_DECODER_VERSION, data) # type: str
+        cached_data = disk_cache.get(key) # type: Optional[bytes]
+        if cached_data is not None:
+            data = bytearray(cached_data)
+        else:
+            unobfuscate_data(data)
+            disk_cache.put(key, data)
+
+    output.write_file(get_out_fname(cmf_fname, data), data)
+
+
+def get_out_fname(cmf_fname, data): # type: (str, Union[bytes, bytearray]) -> str
+    """Names the output after the kind of module the decoded data is."""
+    file_format = detect_format(cmf_fname, bytes(data[:SNIFF_WINDOW_SIZE]), len(data), inside=FORMAT_CMF) # type: Optional[FileFormat]
+    if file_format is None:
+        return os.path.join(*[OUT_DIR, cmf_fname + ".unknown"])
+    return os.path.join(*[OUT_DIR, cmf_fname + "." + file_format.name])
+
+
+def process_cmfs_pipelined(cmf_fnames, *, disk_cache=None, output=None, max_workers=None): # type: (List[str], *, Optional[DiskCache], Optional[OutputBackend], Optional[int]) -> None
+    """Like process_cmf for each file, but reading, decoding and writing all at once.
+
+    Decoding is done in worker processes.
+    """
+    if output is None:
+        output = DirectoryOutput()
+
+    def read(cmf_fname): # type: (str) -> Tuple[bytes, Optional[bytes]]
+        with open(cmf_fname, "rb") as infp:
+            raw_data = infp.read() # type: bytes
+        cached_data = None # type: Optional[bytes]
+        if disk_cache is not None:
+            cached_data = disk_cache.get(DiskCache.make_key("cmf", CMF_DECODER_VERSION, raw_data))
+        return (raw_data, cached_data,)
+
+    def write(cmf_fname, decoded): # type: (str, Tuple[bytes, bytes, bool]) -> None
+        raw_data, data, was_cached = decoded
+        print(f"Processing {cmf_fname!r}")
+        if disk_cache is not None and not was_cached:
+            disk_cache.put(DiskCache.make_key("cmf", CMF_DECODER_VERSION, raw_data), data)
+        output.write_file(get_out_fname(cmf_fname, data), data)
+
+    run_pipeline(
+        cmf_fnames,
+        read=read,
+        decode=_decode_for_pipeline,
+        write=write,
+        max_workers=max_workers,
+    )
+
 
-    with open(out_fname, "wb") as outfp:
-        outfp.write(data)
+def _decode_for_pipeline(cmf_fname, read_data): # type: (str, Tuple[bytes, Optional[bytes]]) -> Tuple[bytes, bytes, bool]
+    raw_data, cached_data = read_data
+    if cached_data is not None:
+        return (raw_data, cached_data, True,)
+    data = bytearray(raw_data) # type: bytearray
+    unobfuscate_data(data)
+    return (raw_data, bytes(data), False,)
 
 
 if __name__ == "__main__":
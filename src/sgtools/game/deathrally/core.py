@@ -2,6 +2,11 @@
 # vim: set sts=4 sw=4 et :
 
 from collections import OrderedDict
+from concurrent.futures import Executor
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+import io
 import os
 import os.path
 import struct
@@ -12,39 +17,42 @@ try:
 except ImportError:
     TYPE_CHECKING = False
 else:
+    from typing import Dict
+    from typing import Callable
+    from typing import Hashable
+    from typing import Iterable
+    from typing import Iterator
     from typing import Mapping
     from typing import IO
     from typing import List
+    from typing import Optional
     from typing import Tuple
     from typing import Type
     from typing import TypeVar
+    from typing import Union
     from sgtools.base.core import TCoreFile
 
     TDeathRallyArchive = TypeVar("TDeathRallyArchive", bound="DeathRallyArchive")
     TDeathRallyCmfFile = TypeVar("TDeathRallyCmfFile", bound="DeathRallyCmfFile")
 
+from sgtools.base.cache import LruByteCache
+from sgtools.base.cache import payload_cache
 from sgtools.base.core import CoreArchive
 from sgtools.base.core import CoreDirectory
 from sgtools.base.core import CoreFile
 from sgtools.base.core import CoreGameData
 from sgtools.base.core import UnknownFile
 from sgtools.game.deathrally.bpa import BpaReader
-
-
-UNHANDLED_FILES = [
-    "CDROM.INI",
-    "DR.CFG",
-    "DR.SG0",
-    "DR.SG7",
-    "DRHELP.EXE",
-    "ENDANI.HAF",
-    "ENDANI0.HAF",
-    "RALLY.BAT",
-    "RALLY.EXE",
-    "RALLY.ICO",
-    "SANIM.HAF",
-    "SETUP.EXE",
-] # type: List[str]
+from sgtools.game.deathrally.bpa import write_bpa_file_name
+from sgtools.game.deathrally.cmf import obfuscate_data
+from sgtools.game.deathrally.cmf import unobfuscate_data
+from sgtools.game.deathrally.formats import FORMAT_CMF
+from sgtools.game.deathrally.formats import FileFormat
+from sgtools.game.deathrally.formats import SNIFF_WINDOW_SIZE
+from sgtools.game.deathrally.formats import UNHANDLED_FILES
+from sgtools.game.deathrally.formats import detect_format
+from sgtools.game.deathrally.formats import detect_formats
+from sgtools.game.deathrally.formats import make_member_file
 
 
 BPA_ARCHIVES = [
@@ -64,18 +72,124 @@ BPA_ARCHIVES = [
     "TR9.BPA",
 ] # type: List[str]
 
+# Enough of a CMF file to tell what's in it.
+CMF_HEADER_SIZE = 0x30 # type: int
+assert CMF_HEADER_SIZE <= SNIFF_WINDOW_SIZE
+
 
 class DeathRallyGameData(CoreGameData):
-    __slots__ = ()
+    """The Death Rally game directory.
+
+    With lazy, only the archives' FATs are read,
+    and file data is loaded on demand into cache (payload_cache by default).
+    The archives then stay open until close() is called.
+
+    Otherwise, with max_workers above 1, the archives are read on a thread pool,
+    and the music is unobfuscated on a process pool (or the thread pool if use_processes is off).
+    The archives always come back in BPA_ARCHIVES order.
+    """
+    __slots__ = (
+        "_max_workers",
+        "_use_processes",
+        "_lazy",
+        "_cache",
+        "_open_archives",
+    )
+
+    def __init__(self, *, max_workers=1, use_processes=True, lazy=False, cache=None): # type: (*, int, bool, bool, Optional[LruByteCache]) -> None
+        self._max_workers = max_workers # type: int
+        self._use_processes = use_processes # type: bool
+        self._lazy = lazy # type: bool
+        self._cache = cache # type: Optional[LruByteCache]
+        self._open_archives = [] # type: List[DeathRallyArchive]
+
+    def __enter__(self): # type: () -> DeathRallyGameData
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback): # type: (object, object, object) -> None
+        self.close()
+
+    def close(self): # type: () -> None
+        """Closes every archive opened lazily so far."""
+        while len(self._open_archives) >= 1:
+            self._open_archives.pop().close()
 
     def load_files(self): # type: () -> Mapping[str, CoreFile]
-        files = [] # type: List[Tuple[str, CoreFile]]
+        if self._max_workers > 1 and not self._lazy:
+            return self._load_files_parallel()
+
+        return OrderedDict(self.iter_files())
+
+    def iter_files(self): # type: () -> Iterator[Tuple[str, CoreFile]]
+        if self._max_workers > 1 and not self._lazy:
+            yield from self.load_files().items()
+            return
+
+        # Only load each archive as it's reached.
         for fname in BPA_ARCHIVES:
-            files.append((fname, DeathRallyArchive.read_from_file_name(fname),))
+            yield (fname, self._load_archive(fname),)
+
+    def _load_archive(self, fname): # type: (str) -> DeathRallyArchive
+        if self._lazy:
+            archive = DeathRallyArchive.open_file_name(fname, cache=self._cache)
+            self._open_archives.append(archive)
+            return archive
+        else:
+            return DeathRallyArchive.read_from_file_name(fname)
+
+    def _load_files_parallel(self): # type: () -> Mapping[str, CoreFile]
+        with ThreadPoolExecutor(max_workers=self._max_workers) as io_pool:
+            if self._use_processes:
+                cpu_pool = ProcessPoolExecutor(max_workers=self._max_workers) # type: Executor
+            else:
+                cpu_pool = io_pool
+
+            with cpu_pool:
+                member_futures = [
+                    io_pool.submit(_read_bpa_members, fname)
+                    for fname in BPA_ARCHIVES
+                ] # type: List[Future[List[Tuple[str, bytes]]]]
+
+                # Hand the music off for decoding as each archive comes in.
+                pending = [] # type: List[Tuple[str, List[Tuple[str, bytes]], Dict[int, Future[bytes]]]]
+                for fname, member_future in zip(BPA_ARCHIVES, member_futures):
+                    members = member_future.result()
+                    decoded = {
+                        midx: cpu_pool.submit(DeathRallyCmfFile._unobfuscate_data, member_data)
+                        for midx, (member_fname, member_data,) in enumerate(members)
+                        if DeathRallyArchive._is_obfuscated(member_fname)
+                    } # type: Dict[int, Future[bytes]]
+                    pending.append((fname, members, decoded,))
+
+                files = [] # type: List[Tuple[str, CoreFile]]
+                for fname, members, decoded in pending:
+                    archive_files = [] # type: List[Tuple[str, CoreFile]]
+                    for midx, (member_fname, member_data,) in enumerate(members):
+                        if midx in decoded:
+                            file = DeathRallyCmfFile(
+                                fname=member_fname,
+                                data=decoded[midx].result(),
+                                obfuscated=False,
+                            ) # type: CoreFile
+                        else:
+                            file = DeathRallyArchive._make_file(member_fname, member_data)
+                        archive_files.append((file.get_file_name(), file,))
+                    files.append((fname, DeathRallyArchive(
+                        fname=fname,
+                        file_map=OrderedDict(archive_files),
+                    ),))
+
         return OrderedDict(files)
 
     def save_files(self, file_map): # type: (Mapping[str, CoreFile]) -> None
-        raise NotImplementedError()
+        """Writes each archive in file_map to its file name, and any other file as-is."""
+        for fname, file in file_map.items():
+            if isinstance(file, CoreDirectory):
+                write_bpa_file_name(fname, _iter_stored_files(file.iter_files()))
+            else:
+                data = _get_stored_file(fname, file)[1]
+                with open(fname, "wb") as fp:
+                    fp.write(data)
 
     @classmethod
     def read_from_file_object(cls, *, fname, fp): # type: (Type[TCoreFile], *, str, IO[bytes]) -> TCoreFile
@@ -83,75 +197,194 @@ class DeathRallyGameData(CoreGameData):
 
 
 class DeathRallyArchive(CoreArchive):
+    """A Death Rally BPA archive.
+
+    If it was mapped, its files' data are memoryviews into the mapping,
+    which stay valid until close() is called.
+    If it was opened lazily, its files' data are read on demand until close() is called.
+    """
     __slots__ = (
         "_fname",
         "_file_map",
+        "_file_index",
+        "_bpa_reader",
+        "_fp",
+        "_cache",
     )
 
-    def __init__(self, *, fname, file_map): # type: (*, str, Mapping[str, CoreFile]) -> None
+    def __init__(self, *, fname, file_map, bpa_reader=None, fp=None, cache=None): # type: (*, str, Mapping[str, CoreFile], Optional[BpaReader], Optional[IO[bytes]], Optional[LruByteCache]) -> None
         self._fname = fname
         self._file_map = file_map
+        self._bpa_reader = bpa_reader
+        self._fp = fp
+        self._cache = cache
+
+        # DOS doesn't care about case, so neither do lookups.
+        self._file_index = {} # type: Dict[str, CoreFile]
+        for file_fname, file in file_map.items():
+            self._file_index.setdefault(file_fname.upper(), file)
+
+    def __enter__(self): # type: () -> DeathRallyArchive
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback): # type: (object, object, object) -> None
+        self.close()
+
+    def close(self): # type: () -> None
+        if self._fp is not None:
+            # Opened lazily, so drop whatever was loaded; it can't be loaded again anyway.
+            cache = self._cache if self._cache is not None else payload_cache
+            for file in self._file_map.values():
+                if isinstance(file, (UnknownFile, DeathRallyCmfFile)):
+                    cache.discard(file.get_cache_key())
+        if self._bpa_reader is not None:
+            self._bpa_reader.close()
+            self._bpa_reader = None
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
 
     def get_file_name(self): # type: () -> str
         return self._fname
 
     @classmethod
-    def read_from_file_object(cls, *, fname, fp): # type: (Type[TDeathRallyArchive], *, str, IO[bytes]) -> TDeathRallyArchive
+    def map_file_name(cls, fname): # type: (Type[TDeathRallyArchive], str) -> TDeathRallyArchive
+        """Maps an archive read-only instead of reading it into memory."""
+        with open(fname, "rb") as fp:
+            return cls.read_from_file_object(fname=fname, fp=fp, use_mmap=True)
+
+    @classmethod
+    def open_file_name(cls, fname, *, cache=None): # type: (Type[TDeathRallyArchive], str, *, Optional[LruByteCache]) -> TDeathRallyArchive
+        """Opens an archive, only reading its FAT up front.
+
+        File data is read when it's asked for, and held in cache (payload_cache by default)
+        under (archive path, member offset, member name) until it's evicted or close() is called.
+        The archive stays open until close() is called.
+        """
+        bpa_path = os.path.abspath(fname)
+        fp = open(fname, "rb")
+        try:
+            bpa_reader = BpaReader(
+                fname=fname,
+                fp=fp,
+                lazy=True,
+            )
+
+            files = [] # type: List[Tuple[str, CoreFile]]
+            for fat_entry in bpa_reader.each_fat_entry():
+                file = make_member_file(
+                    fat_entry.fname,
+                    loader=fat_entry.get_data,
+                    header=bpa_reader.read_data(fat_entry.offset, min(fat_entry.size, SNIFF_WINDOW_SIZE)),
+                    size=fat_entry.size,
+                    cache=cache,
+                    cache_key=(bpa_path, fat_entry.offset, fat_entry.fname),
+                )
+                files.append((file.get_file_name(), file,))
+        except BaseException:
+            fp.close()
+            raise
+
+        return cls(
+            fname=fname,
+            file_map=OrderedDict(files),
+            bpa_reader=bpa_reader,
+            fp=fp,
+            cache=cache,
+        )
+
+    @classmethod
+    def read_from_file_object(cls, *, fname, fp, use_mmap=False): # type: (Type[TDeathRallyArchive], *, str, IO[bytes], bool) -> TDeathRallyArchive
         bpa_reader = BpaReader(
             fname=fname,
             fp=fp,
+            use_mmap=use_mmap,
         )
         bpa_fname = fname # type: str
 
         files = [] # type: List[Tuple[str, CoreFile]]
         for fat_entry in bpa_reader.each_fat_entry():
-            file_fname = fat_entry.fname
-            file_data = fat_entry.data
-
-            if file_fname.endswith(".CMF"):
-                file = DeathRallyCmfFile(
-                    fname=file_fname,
-                    data=file_data,
-                ) # type: CoreFile
-                file_fname = file.get_file_name()
-            else:
-                file = UnknownFile(
-                    fname=file_fname,
-                    data=file_data,
-                )
-
-            files.append((file_fname, file,))
+            file = cls._make_file(fat_entry.fname, fat_entry.data)
+            files.append((file.get_file_name(), file,))
 
         return cls(
             fname=bpa_fname,
             file_map=OrderedDict(files),
+            bpa_reader=(bpa_reader if use_mmap else None),
         )
 
+    @staticmethod
+    def _is_obfuscated(fname): # type: (str) -> bool
+        file_format = detect_format(fname, b"") # type: Optional[FileFormat]
+        return file_format is not None and file_format.name == FORMAT_CMF
+
+    @staticmethod
+    def _make_file(fname, data): # type: (str, Union[bytes, memoryview]) -> CoreFile
+        return make_member_file(fname, data=data)
+
     def load_files(self): # type: () -> Mapping[str, CoreFile]
         return OrderedDict(self._file_map)
 
+    def iter_files(self): # type: () -> Iterable[Tuple[str, CoreFile]]
+        return self._file_map.items()
+
+    def get_file(self, name): # type: (str) -> CoreFile
+        """Looks up a file by name, ignoring case. Raises KeyError if it isn't there."""
+        return self._file_index[name.upper()]
+
+    def read_member(self, name): # type: (str) -> Union[bytes, memoryview]
+        file = self.get_file(name)
+        if not isinstance(file, (UnknownFile, DeathRallyCmfFile)):
+            raise TypeError(f"{name!r} in {self._fname!r} has no data")
+        return file.get_data()
+
+    def open_member(self, name): # type: (str) -> IO[bytes]
+        return io.BytesIO(self.read_member(name))
+
     def save_files(self, file_map): # type: (Mapping[str, CoreFile]) -> None
-        raise NotImplementedError()
+        """Writes file_map out as this archive's file.
+
+        Each file is loaded just before it's written,
+        so lazily-loaded files are streamed through one at a time.
+        Music is obfuscated again and stored under its original .CMF name.
+        """
+        write_bpa_file_name(self._fname, _iter_stored_files(file_map.items()))
 
 
 class DeathRallyCmfFile(CoreFile):
-    """A file definition for a Death Rally obfuscated music/sound file type."""
+    """A file definition for a Death Rally obfuscated music/sound file type.
+
+    Like UnknownFile, it can be given a loader for the obfuscated data instead of the data itself.
+    It then also needs the first CMF_HEADER_SIZE bytes of the obfuscated data up front,
+    so it can tell what kind of file it is.
+    """
 
     __slots__ = (
         "_fname",
+        "_cmf_fname",
         "_data",
+        "_loader",
+        "_cache",
+        "_cache_key",
     )
 
-    def __init__(self, *, fname, data): # type: (str, bytes) -> None
-        heuristic = [] # type: List[str]
-
-        self._data = self._unobfuscate_data(data)
-
-        if self._data[0x002C:0x002C+0x04] == b"SCRM":
-            heuristic.append("S3M")
-        if self._data[0x0000:0x0000+0x11] == b"Extended Module: ":
-            heuristic.append("XM")
+    def __init__(self, *, fname, data=None, obfuscated=True, loader=None, header=None, cache=None, cache_key=None): # type: (str, Optional[Union[bytes, memoryview]], bool, Optional[Callable[[], Union[bytes, memoryview]]], Optional[bytes], Optional[LruByteCache], Optional[Hashable]) -> None
+        self._cmf_fname = fname
+        self._loader = loader
+        self._cache = cache
+        self._cache_key = cache_key if cache_key is not None else object() # type: Hashable
+        if data is None:
+            assert loader is not None and header is not None
+            self._data = None # type: Optional[bytes]
+            header = self._unobfuscate_data(header)
+        elif obfuscated:
+            self._data = self._unobfuscate_data(data)
+            header = self._data
+        else:
+            self._data = bytes(data)
+            header = self._data
 
+        heuristic = self.get_heuristic(header) # type: List[str]
         if heuristic == []:
             self._fname = fname
         elif heuristic == ["S3M"]:
@@ -161,36 +394,95 @@ class DeathRallyCmfFile(CoreFile):
         else:
             raise Exception(f"confused heuristic {heuristic!r} for file {fname!r}")
 
+    @classmethod
+    def from_member(cls, *, fname, data=None, loader=None, header=None, cache=None, cache_key=None): # type: (Type[TDeathRallyCmfFile], *, str, Optional[Union[bytes, memoryview]], Optional[Callable[[], Union[bytes, memoryview]]], Optional[bytes], Optional[LruByteCache], Optional[Hashable]) -> TDeathRallyCmfFile
+        if data is not None:
+            return cls(fname=fname, data=data)
+        return cls(fname=fname, loader=loader, header=header, cache=cache, cache_key=cache_key)
+
+    @staticmethod
+    def get_heuristic(header): # type: (Union[bytes, bytearray]) -> List[str]
+        """Guesses what's in an unobfuscated file from its first CMF_HEADER_SIZE bytes."""
+        return [
+            file_format.name.upper()
+            for file_format in detect_formats("", bytes(header[:SNIFF_WINDOW_SIZE]), None, inside=FORMAT_CMF)
+        ]
+
     @staticmethod
-    def _unobfuscate_data(data): # type: (bytes) -> bytes
+    def _unobfuscate_data(data): # type: (Union[bytes, memoryview]) -> bytes
         """Unobfuscate an obfuscated music/sound file."""
         wdata = bytearray(data)
-        for pos in range(len(wdata)):
-            v = wdata[pos]
-            v = (((v<<(pos%7))|(v>>(8-(pos%7)))) - (0x6D + (pos*0x11))) & 0xFF
-            wdata[pos] = v
+        unobfuscate_data(wdata)
         return bytes(wdata)
 
     def get_file_name(self): # type: () -> str
         return self._fname
 
+    def get_data(self): # type: () -> bytes
+        if self._data is not None:
+            return self._data
+        cache = self._cache if self._cache is not None else payload_cache
+        return cache.get(self._cache_key, self._load_data)
+
+    def get_cache_key(self): # type: () -> Hashable
+        return self._cache_key
+
+    def _load_data(self): # type: () -> bytes
+        assert self._loader is not None
+        return self._unobfuscate_data(self._loader())
+
+    def get_cmf_file_name(self): # type: () -> str
+        """Returns the name this file had in its archive."""
+        return self._cmf_fname
+
+    def get_obfuscated_data(self): # type: () -> bytes
+        if self._data is None:
+            # Still in its original form, so no need to decode it just to encode it again.
+            assert self._loader is not None
+            return bytes(self._loader())
+
+        wdata = bytearray(self._data)
+        obfuscate_data(wdata)
+        return bytes(wdata)
+
     @classmethod
     def read_from_file_object(cls, *, fname, fp): # type: (Type[TDeathRallyCmfFile], *, str, IO[bytes]) -> TDeathRallyCmfFile
         return cls(fname=fname, data=fp.read())
 
 
+def _get_stored_file(fname, file): # type: (str, CoreFile) -> Tuple[str, Union[bytes, memoryview]]
+    """Returns the name and data a file should be stored with in an archive."""
+    if isinstance(file, DeathRallyCmfFile):
+        return (file.get_cmf_file_name(), file.get_obfuscated_data(),)
+    elif isinstance(file, UnknownFile):
+        return (fname, file.get_data_uncached(),)
+    else:
+        raise TypeError(f"can't store {file!r} as {fname!r}")
+
+
+def _iter_stored_files(files): # type: (Iterable[Tuple[str, CoreFile]]) -> Iterator[Tuple[str, Union[bytes, memoryview]]]
+    for fname, file in files:
+        yield _get_stored_file(fname, file)
+
+
+def _read_bpa_members(fname): # type: (str) -> List[Tuple[str, bytes]]
+    with open(fname, "rb") as fp:
+        bpa_reader = BpaReader(
+            fname=fname,
+            fp=fp,
+        )
+        return [
+            (fat_entry.fname, bytes(fat_entry.data),)
+            for fat_entry in bpa_reader.each_fat_entry()
+        ]
+
+
 def main(): # type: () -> None
-    gamedata = DeathRallyGameData()
-    remaining_file_maps = [] # type: List[Tuple[List[str], CoreFile]]
-    remaining_file_maps.append((["workdir"], gamedata,))
-    while len(remaining_file_maps) >= 1:
-        pathlist, file, = remaining_file_maps.pop(0) # type: Tuple[List[str], CoreFile]
-        if isinstance(file, CoreDirectory):
-            file_map = file.load_files()
-            for subfname, subfile in file_map.items():
-                remaining_file_maps.append((pathlist + [subfname], subfile,))
-        else:
-            print(f"- {'/'.join(pathlist)!r}: {file!r}")
+    with DeathRallyGameData() as gamedata:
+        # Depth first, so each archive can be dropped once it has been listed.
+        for path, file in gamedata.walk():
+            if not isinstance(file, CoreDirectory):
+                print(f"- {path!r}: {file!r}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3 --
+# vim: set sts=4 sw=4 et :
+
+import importlib
+
+try:
+    from typing import TYPE_CHECKING
+except ImportError:
+    TYPE_CHECKING = False
+else:
+    from typing import Callable
+    from typing import Hashable
+    from typing import List
+    from typing import Optional
+    from typing import Type
+    from typing import Union
+
+    from sgtools.base.cache import LruByteCache
+    from sgtools.base.core import CoreFile
+
+    TSniffer = Callable[[str, bytes, Optional[int]], bool]
+
+from sgtools.base.core import UnknownFile
+
+
+# How much of the start of a file every sniffer gets to look at.
+SNIFF_WINDOW_SIZE = 0x30 # type: int
+
+FORMAT_UNHANDLED = "unhandled" # type: str
+FORMAT_CMF = "cmf" # type: str
+FORMAT_BPK = "bpk" # type: str
+FORMAT_HAF = "haf" # type: str
+
+# Found in the decoded data of the formats above, rather than as files of their own.
+FORMAT_S3M = "s3m" # type: str
+FORMAT_XM = "xm" # type: str
+FORMAT_RIX3 = "rix3" # type: str
+
+# Files in the game directory that nothing here knows what to do with.
+UNHANDLED_FILES = [
+    "CDROM.INI",
+    "DR.CFG",
+    "DR.SG0",
+    "DR.SG7",
+    "DRHELP.EXE",
+    "ENDANI.HAF",
+    "ENDANI0.HAF",
+    "RALLY.BAT",
+    "RALLY.EXE",
+    "RALLY.ICO",
+    "SANIM.HAF",
+    "SETUP.EXE",
+] # type: List[str]
+
+
+class FileFormat:
+    """A kind of file, how to spot it, and which CoreFile class handles it.
+
+    The handler is named as "module:Class", and only imported the first time it's needed.
+    Handlers need a from_member() classmethod like UnknownFile's.
+    Formats inside another one are spotted in its decoded data, and have no handler.
+    """
+    __slots__ = (
+        "name",
+        "inside",
+        "_sniff",
+        "_handler_name",
+        "_handler",
+    )
+
+    def __init__(self, *, name, sniff, handler=None, inside=None): # type: (*, str, TSniffer, Optional[str], Optional[str]) -> None
+        assert (handler is None) != (inside is None)
+        self.name = name # type: str
+        self.inside = inside # type: Optional[str]
+        self._sniff = sniff # type: TSniffer
+        self._handler_name = handler # type: Optional[str]
+        self._handler = None # type: Optional[Type[CoreFile]]
+
+    def __repr__(self): # type: () -> str
+        return f"FileFormat(name={self.name!r}, handler={self._handler_name!r}, inside={self.inside!r})"
+
+    def matches(self, fname, header, size): # type: (str, bytes, Optional[int]) -> bool
+        return self._sniff(fname, header, size)
+
+    def get_handler(self): # type: () -> Type[CoreFile]
+        if self._handler is None:
+            assert self._handler_name is not None
+            module_name, _, class_name = self._handler_name.partition(":")
+            self._handler = getattr(importlib.import_module(module_name), class_name)
+        return self._handler
+
+
+# Checked in order, so more specific formats should come first.
+_formats = [] # type: List[FileFormat]
+
+
+def register_format(name, *, sniff, handler=None, inside=None): # type: (str, *, TSniffer, Optional[str], Optional[str]) -> FileFormat
+    """Adds a format to the registry.
+
+    sniff(fname, header, size) is given the file's name,
+    up to SNIFF_WINDOW_SIZE bytes from its start, and its size if known.
+    It should be cheap and not import anything heavy.
+    Give either a handler for archive members, or the format whose decoded data this is found inside.
+    """
+    file_format = FileFormat(name=name, sniff=sniff, handler=handler, inside=inside)
+    _formats.append(file_format)
+    return file_format
+
+
+def get_formats(): # type: () -> List[FileFormat]
+    return list(_formats)
+
+
+def detect_format(fname, header, size=None, *, inside=None): # type: (str, bytes, Optional[int], *, Optional[str]) -> Optional[FileFormat]
+    """Finds the first registered format that claims a file, or None.
+
+    With inside, header and size are from the decoded data of a file of that format,
+    and only the formats found inside it are tried.
+    """
+    for file_format in _formats:
+        if file_format.inside == inside and file_format.matches(fname, header, size):
+            return file_format
+    return None
+
+
+def detect_formats(fname, header, size=None, *, inside=None): # type: (str, bytes, Optional[int], *, Optional[str]) -> List[FileFormat]
+    """Like detect_format, but finds every format that claims a file."""
+    return [
+        file_format
+        for file_format in _formats
+        if file_format.inside == inside and file_format.matches(fname, header, size)
+    ]
+
+
+def make_member_file(fname, *, data=None, loader=None, header=None, size=None, cache=None, cache_key=None): # type: (str, *, Optional[Union[bytes, memoryview]], Optional[Callable[[], Union[bytes, memoryview]]], Optional[bytes], Optional[int], Optional[LruByteCache], Optional[Hashable]) -> CoreFile
+    """Makes a file of the right type for an archive member.
+
+    Give either data, or a loader along with the first SNIFF_WINDOW_SIZE bytes as header,
+    so nothing needs reading again to work out what it is.
+    Anything no format claims becomes an UnknownFile.
+    """
+    if data is not None:
+        if header is None:
+            header = bytes(data[:SNIFF_WINDOW_SIZE])
+        if size is None:
+            size = len(data)
+    assert header is not None
+
+    file_format = detect_format(fname, header, size)
+    handler = UnknownFile if file_format is None else file_format.get_handler() # type: Type[CoreFile]
+    return handler.from_member( # type: ignore[attr-defined]
+        fname=fname,
+        data=data,
+        loader=loader,
+        header=header,
+        cache=cache,
+        cache_key=cache_key,
+    )
+
+
+def _sniff_unhandled(fname, header, size): # type: (str, bytes, Optional[int]) -> bool
+    return fname.upper() in UNHANDLED_FILES
+
+
+def _sniff_cmf(fname, header, size): # type: (str, bytes, Optional[int]) -> bool
+    # Obfuscated, so the name is all there is to go on before decoding it.
+    # What's inside is told apart by the S3M and XM sniffers below once it is.
+    return fname.endswith(".CMF")
+
+
+def _sniff_bpk(fname, header, size): # type: (str, bytes, Optional[int]) -> bool
+    # LZW compressed with no header of its own, so again only the name says what it is.
+    # RIX3 images are spotted in the decoded data below; other images are only known
+    # by their decoded length, which bpk.identify() looks up along with their palettes.
+    return fname.upper().endswith(".BPK")
+
+
+def _sniff_haf(fname, header, size): # type: (str, bytes, Optional[int]) -> bool
+    # There's no magic number, just a frame count, so the name has to match
+    # and the size has to be big enough for the tables that count implies.
+    if not fname.upper().endswith(".HAF") or len(header) < 2:
+        return False
+    # Frame count, then a byte each of sound trigger and frame length per frame.
+    frame_count = header[0] | (header[1] << 8) # type: int
+    return size is None or 2 + 2*frame_count <= size
+
+
+def _sniff_s3m(fname, header, size): # type: (str, bytes, Optional[int]) -> bool
+    return header[0x2C:0x2C+0x4] == b"SCRM"
+
+
+def _sniff_xm(fname, header, size): # type: (str, bytes, Optional[int]) -> bool
+    return header[0x00:0x00+0x11] == b"Extended Module: "
+
+
+def _sniff_rix3(fname, header, size): # type: (str, bytes, Optional[int]) -> bool
+    return header[:4] == b"RIX3"
+
+
+# First, so the odd HAF files in UNHANDLED_FILES aren't taken for animations.
+register_format(FORMAT_UNHANDLED, sniff=_sniff_unhandled, handler="sgtools.base.core:UnknownFile")
+register_format(FORMAT_CMF, sniff=_sniff_cmf, handler="sgtools.game.deathrally.core:DeathRallyCmfFile")
+register_format(FORMAT_BPK, sniff=_sniff_bpk, handler="sgtools.game.deathrally.bpk:DeathRallyBpkFile")
+register_format(FORMAT_HAF, sniff=_sniff_haf, handler="sgtools.game.deathrally.haf:DeathRallyHafFile")
+register_format(FORMAT_S3M, sniff=_sniff_s3m, inside=FORMAT_CMF)
+register_format(FORMAT_XM, sniff=_sniff_xm, inside=FORMAT_CMF)
+register_format(FORMAT_RIX3, sniff=_sniff_rix3, inside=FORMAT_BPK)
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3 --
+# vim: set sts=4 sw=4 et :
+
+from array import array
+import io
+import os
+import os.path
+import struct
+import sys
+
+try:
+    from typing import TYPE_CHECKING
+except ImportError:
+    TYPE_CHECKING = False
+else:
+    from typing import IO
+    from typing import Iterator
+    from typing import List
+    from typing import Optional
+    from typing import Tuple
+
+from sgtools.base.core import UnknownFile
+from sgtools.base.image import PALETTE_6TO8
+from sgtools.base.io import PositionalReader
+
+
+GIF_HEADER = b"".join([
+    b"GIF89a", # Header
+
+    # Logical Screen Descriptor
+    struct.pack("<HH", 320, 120), # Logical Screen Width and Height
+    struct.pack("<B", 0b01110111), # flags
+    struct.pack("<B", 0), # Background Color Index (ignored)
+    struct.pack("<B", 0), # Pixel Aspect Ratio (TODO: apply 240/200 height)
+
+    # Application Extension Block: NETSCAPE2.0 animation
+    struct.pack("<BB", 0x21, 0xFF), # Application Extension Block
+    b"\x0BNETSCAPE2.0", # Authentication Code
+    struct.pack("<BBh", 3, 1, -1), # block length, sub-block index (always 1), repetition count
+    struct.pack("<B", 0), # end of AEB
+]) # type: bytes
+
+# Graphic Control Extension then Image Descriptor, which come before each frame.
+GIF_FRAME_HEADER = struct.Struct("<BB" "BBHB" "B" "B" "HH" "HH" "B") # type: struct.Struct
+
+# Frame index files sit next to the HAF file they're for.
+HAF_INDEX_SUFFIX = ".idx" # type: str
+HAF_INDEX_MAGIC = b"HAFI" # type: bytes
+HAF_INDEX_VERSION = 1 # type: int
+HAF_INDEX_HEADER = struct.Struct("<4sHQQH") # type: struct.Struct
+
+
+class HafFrame:
+    """One frame of a HAF animation.
+
+    palette has already been widened to 8-bit RGB,
+    and image_data is GIF table-based image data, ready to go after an image descriptor.
+    length is how long the frame is shown for, in 70ths of a second.
+    """
+    __slots__ = (
+        "index",
+        "palette",
+        "image_data",
+        "length",
+        "sound_trigger",
+    )
+
+    def __init__(self, *, index, palette, image_data, length, sound_trigger): # type: (*, int, bytes, bytes, int, int) -> None
+        self.index = index # type: int
+        self.palette = palette # type: bytes
+        self.image_data = image_data # type: bytes
+        self.length = length # type: int
+        self.sound_trigger = sound_trigger # type: int
+
+
+class DeathRallyHafFile(UnknownFile):
+    """A HAF animation, which is only parsed when asked for."""
+    __slots__ = ()
+
+    def open_reader(self): # type: () -> HafReader
+        return HafReader(io.BytesIO(self.get_data()))
+
+
+class HafReader:
+    """Random-access reader for a HAF animation.
+
+    The offset of every frame is found up front by hopping from one length prefix to the next,
+    so frame(n) only has to read frame n.
+    Reads go through positional I/O, so fp has to stay open, and can be shared between threads.
+    """
+    __slots__ = (
+        "_fp",
+        "_pfp",
+        "_frame_count",
+        "_sound_triggers",
+        "_frame_lengths",
+        "_offsets",
+        "_sizes",
+    )
+
+    def __init__(self, fp, *, index=None): # type: (IO[bytes], *, Optional[Tuple[array[int], array[int]]]) -> None
+        self._fp = fp # type: IO[bytes]
+        self._pfp = PositionalReader(fp) # type: PositionalReader
+
+        frame_count, = struct.unpack("<H", self._pfp.read_at(0, 2)) # type: Tuple[int]
+        self._frame_count = frame_count # type: int
+        tables = self._pfp.read_at(2, 2*frame_count) # type: bytes
+        assert len(tables) == 2*frame_count
+        self._sound_triggers = tables[:frame_count] # type: bytes
+        self._frame_lengths = tables[frame_count:] # type: bytes
+
+        if index is None:
+            index = self._build_index()
+        self._offsets, self._sizes = index
+
+    @classmethod
+    def open_file_name(cls, fname, *, use_index_file=True): # type: (str, *, bool) -> HafReader
+        """Opens a HAF file, reusing its index file if it's up to date and writing one if not."""
+        fp = open(fname, "rb")
+        try:
+            if not use_index_file:
+                return cls(fp)
+
+            st = os.fstat(fp.fileno())
+            index_fname = fname + HAF_INDEX_SUFFIX # type: str
+            index = _load_index(index_fname, st.st_size, st.st_mtime_ns)
+            reader = cls(fp, index=index)
+        except BaseException:
+            fp.close()
+            raise
+
+        if index is None:
+            try:
+                reader.save_index(index_fname, st.st_size, st.st_mtime_ns)
+            except OSError:
+                pass # read-only directory, most likely; the index is only a speedup
+        return reader
+
+    def __enter__(self): # type: () -> HafReader
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback): # type: (object, object, object) -> None
+        self.close()
+
+    def close(self): # type: () -> None
+        self._fp.close()
+
+    def _build_index(self): # type: () -> Tuple[array[int], array[int]]
+        offsets = array("I") # type: array[int]
+        sizes = array("H") # type: array[int]
+        offset = 2 + 2*self._frame_count # type: int
+        for fidx in range(self._frame_count):
+            raw_size = self._pfp.read_at(offset, 2) # type: bytes
+            if len(raw_size) != 2:
+                raise ValueError(f"HAF file ends before frame {fidx}")
+            size, = struct.unpack("<H", raw_size) # type: Tuple[int]
+            offsets.append(offset + 2)
+            sizes.append(size)
+            offset += 2 + size
+        return (offsets, sizes,)
+
+    def save_index(self, index_fname, size, mtime_ns): # type: (str, int, int) -> None
+        """Writes the frame index out, tagged with the size and mtime of the file it's for."""
+        tmp_fname = index_fname + ".tmp" # type: str
+        with open(tmp_fname, "wb") as fp:
+            fp.write(HAF_INDEX_HEADER.pack(HAF_INDEX_MAGIC, HAF_INDEX_VERSION, size, mtime_ns, self._frame_count))
+            fp.write(struct.pack(f"<{self._frame_count}I", *self._offsets))
+            fp.write(struct.pack(f"<{self._frame_count}H", *self._sizes))
+        os.replace(tmp_fname, index_fname)
+
+    def get_frame_count(self): # type: () -> int
+        return self._frame_count
+
+    def __len__(self): # type: () -> int
+        return self._frame_count
+
+    def frame(self, n): # type: (int) -> HafFrame
+        if not (0 <= n < self._frame_count):
+            raise IndexError(f"frame {n} out of range, there are {self._frame_count}")
+
+        raw_frame_data = self._pfp.read_at(self._offsets[n], self._sizes[n]) # type: bytes
+        assert len(raw_frame_data) == self._sizes[n]
+        return HafFrame(
+            index=n,
+            palette=raw_frame_data[:256*3].translate(PALETTE_6TO8),
+            # (omiting the embedded 1-byte GIF Trailer here)
+            image_data=raw_frame_data[256*3:-1],
+            length=self._frame_lengths[n],
+            sound_trigger=self._sound_triggers[n],
+        )
+
+    def iter_frames(self, start=0, stop=None): # type: (int, Optional[int]) -> Iterator[HafFrame]
+        for n in range(*slice(start, stop).indices(self._frame_count)):
+            yield self.frame(n)
+
+    def build_gif(self, start=0, stop=None): # type: (int, Optional[int]) -> bytearray
+        """Converts frames start up to stop to an animated GIF, assembled in memory."""
+        accum_delay = 0
+
+        gif_data = bytearray(GIF_HEADER) # type: bytearray
+        for frame in self.iter_frames(start, stop):
+            accum_delay += frame.length*100
+            delay = accum_delay//70
+            accum_delay -= delay*70
+            gif_data += GIF_FRAME_HEADER.pack(
+                # Graphic Control Extension
+                0x21, 0xF9, # AEB identifier: GCE
+                4, 0b00000000, delay, 0, # GCE data
+                0, # end of AEB
+
+                # Image Descriptor
+                0x2C,
+                0, 0, # Image Left and Top Position
+                320, 120, # Image Width and Height
+                0b10000111, # flags
+            )
+
+            # Local Color Table, Table Based Image Data
+            gif_data += frame.palette
+            gif_data += frame.image_data
+
+        # GIF Trailer
+        gif_data += b"\x3B"
+        return gif_data
+
+    def export_gif(self, gif_fname, start=0, stop=None): # type: (str, int, Optional[int]) -> None
+        with open(gif_fname, "wb") as gif_fp:
+            gif_fp.write(self.build_gif(start, stop))
+
+    def export_frames(self, fname_prefix, start=0, stop=None): # type: (str, int, Optional[int]) -> List[str]
+        """Writes each frame as its own GIF, named fname_prefix-NNNN.gif. Returns the names."""
+        gif_fnames = [] # type: List[str]
+        for n in range(*slice(start, stop).indices(self._frame_count)):
+            gif_fname = f"{fname_prefix}-{n:04d}.gif" # type: str
+            self.export_gif(gif_fname, n, n+1)
+            gif_fnames.append(gif_fname)
+        return gif_fnames
+
+
+def _load_index(index_fname, size, mtime_ns): # type: (str, int, int) -> Optional[Tuple[array[int], array[int]]]
+    """Reads a frame index, or returns None if it's missing or out of date."""
+    try:
+        with open(index_fname, "rb") as fp:
+            raw_index = fp.read() # type: bytes
+    except FileNotFoundError:
+        return None
+
+    if len(raw_index) < HAF_INDEX_HEADER.size:
+        return None
+    magic, version, index_size, index_mtime_ns, frame_count = HAF_INDEX_HEADER.unpack(raw_index[:HAF_INDEX_HEADER.size])
+    if (magic, version, index_size, index_mtime_ns,) != (HAF_INDEX_MAGIC, HAF_INDEX_VERSION, size, mtime_ns,):
+        return None
+    if len(raw_index) != HAF_INDEX_HEADER.size + 6*frame_count:
+        return None
+
+    pos = HAF_INDEX_HEADER.size # type: int
+    offsets = array("I", struct.unpack(f"<{frame_count}I", raw_index[pos:pos+4*frame_count]))
+    pos += 4*frame_count
+    sizes = array("H", struct.unpack(f"<{frame_count}H", raw_index[pos:pos+2*frame_count]))
+    return (offsets, sizes,)
+
+
+def main(): # type: () -> None
+    args = sys.argv[1:] # type: List[str]
+    separate = False # type: bool
+    if args[:1] == ["--separate"]:
+        separate = True
+        args = args[1:]
+
+    haf_fname = args[0] # type: str
+    start = int(args[1]) if len(args) >= 2 else 0 # type: int
+    stop = int(args[2]) if len(args) >= 3 else None # type: Optional[int]
+    fname_root = haf_fname.rpartition(".")[0] if "." in haf_fname else haf_fname # type: str
+
+    with HafReader.open_file_name(haf_fname) as reader:
+        if separate:
+            for gif_fname in reader.export_frames(fname_root, start, stop):
+                print(f"Wrote {gif_fname!r}")
+        else:
+            first, last, _ = slice(start, stop).indices(reader.get_frame_count())
+            gif_fname = f"{fname_root}-{first:04d}-{last:04d}.gif"
+            reader.export_gif(gif_fname, start, stop)
+            print(f"Wrote {gif_fname!r}")
+
+
+if __name__ == "__main__":
+    main()
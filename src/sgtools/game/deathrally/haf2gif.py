@@ -1,9 +1,12 @@
 #!/usr/bin/env python3 --
 # vim: set sts=4 sw=4 et :
 
+from concurrent.futures import ProcessPoolExecutor
+import io
+import itertools
 import os
 import os.path
-import struct
+import shutil
 import sys
 
 try:
@@ -12,78 +15,101 @@ except ImportError:
     TYPE_CHECKING = False
 else:
     from typing import IO
+    from typing import List
+    from typing import Optional
+
+from sgtools.base.diskcache import DiskCache
+from sgtools.base.diskcache import get_default_disk_cache
+from sgtools.game.deathrally.haf import HafReader
+
+
+# Bump this whenever a change to the converter could change its output, to invalidate cached results.
+HAF2GIF_VERSION = 1 # type: int
 
 
 def main(): # type: () -> None
-    for fname in sys.argv[1:]:
+    run(sys.argv[1:])
+
+
+def run(args): # type: (List[str]) -> None
+    """Does what main() does, for args instead of the command line: leading options, then the files."""
+    disk_cache = get_default_disk_cache() # type: Optional[DiskCache]
+    fnames = list(args) # type: List[str]
+    jobs = 1 # type: int
+    if fnames[:1] == ["-j"]:
+        jobs = int(fnames[1])
+        fnames = fnames[2:]
+
+    if jobs > 1:
+        haf2gif_batch(fnames, disk_cache=disk_cache, max_workers=jobs)
+        return
+
+    for fname in fnames:
+        if disk_cache is not None:
+            haf2gif_cached(fname, disk_cache)
+            continue
+
         with open(fname, "rb") as infp:
             haf2gif(fname, infp)
 
 
-def haf2gif(haf_fname, haf_fp): # type: (str, IO[bytes]) -> None
-    print(f"Processing {haf_fname!r}")
-
+def get_gif_fname(haf_fname): # type: (str) -> str
     if "." in haf_fname:
         haf_root = haf_fname.rpartition(".")[0] # type: str
     else:
         haf_root = haf_fname
 
-    gif_fname = haf_root + ".gif"
+    return haf_root + ".gif"
+
 
-    frame_count, = struct.unpack("<H", haf_fp.read(2))
-    sound_triggers = list(haf_fp.read(frame_count))
-    frame_lengths = list(haf_fp.read(frame_count))
+def haf2gif_batch(haf_fnames, *, disk_cache=None, max_workers=None): # type: (List[str], *, Optional[DiskCache], Optional[int]) -> None
+    """Converts several files at once, one per worker process."""
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(convert_file_name, haf_fnames, itertools.repeat(disk_cache))
+        for haf_fname, was_cached in zip(haf_fnames, results):
+            print(f"Processing {haf_fname!r}{' (cached)' if was_cached else ''}")
 
-    accum_delay = 0
 
-    with open(gif_fname, "wb") as gif_fp:
-        gif_fp.write(b"GIF89a") # Header
+def haf2gif_cached(haf_fname, disk_cache): # type: (str, DiskCache) -> None
+    """Like haf2gif, but takes the GIF from disk_cache if it's there, or adds it if not."""
+    was_cached = convert_file_name(haf_fname, disk_cache)
+    print(f"Processing {haf_fname!r}{' (cached)' if was_cached else ''}")
 
-        # Logical Screen Descriptor
-        gif_fp.write(struct.pack("<HH", 320, 120)) # Logical Screen Width and Height
-        gif_fp.write(struct.pack("<B", 0b01110111)) # flags
-        gif_fp.write(struct.pack("<B", 0)) # Background Color Index (ignored)
-        gif_fp.write(struct.pack("<B", 0)) # Pixel Aspect Ratio (TODO: apply 240/200 height)
 
-        # Application Extension Block: NETSCAPE2.0 animation
-        gif_fp.write(struct.pack("<BB", 0x21, 0xFF)) # Application Extension Block
-        gif_fp.write(b"\x0BNETSCAPE2.0") # Authentication Code
-        gif_fp.write(struct.pack("<BBh", 3, 1, -1)) # block length, sub-block index (always 1), repetition count
-        gif_fp.write(struct.pack("<B", 0)) # end of AEB
+def convert_file_name(haf_fname, disk_cache=None): # type: (str, Optional[DiskCache]) -> bool
+    """Writes the GIF for a HAF file without printing anything. Returns whether it came from disk_cache."""
+    with open(haf_fname, "rb") as infp:
+        raw_data = infp.read() # type: bytes
 
-        for fidx in range(frame_count):
-            frame_length, = struct.unpack("<H", haf_fp.read(2))
-            raw_frame_data = bytearray(haf_fp.read(frame_length))
+    if disk_cache is not None:
+        key = DiskCache.make_key("haf2gif", HAF2GIF_VERSION, raw_data) # type: str
+        cached_fp = disk_cache.open(key)
+        if cached_fp is not None:
+            with cached_fp:
+                with open(get_gif_fname(haf_fname), "wb") as gif_fp:
+                    shutil.copyfileobj(cached_fp, gif_fp)
+            return True
 
-            # Fix up the palette, converting from 6bit to 8bit components
-            for i in range(256*3):
-                v = raw_frame_data[i]
-                v = ((v<<6)|v) # 6 * 2 = 12
-                v = v>>4 # 12 - 4 = 8
-                raw_frame_data[i] = v
+    gif_data = build_gif(io.BytesIO(raw_data))
+    with open(get_gif_fname(haf_fname), "wb") as gif_fp:
+        gif_fp.write(gif_data)
+    if disk_cache is not None:
+        disk_cache.put(key, gif_data)
+    return False
 
-            # Graphic Control Extension
-            accum_delay += frame_lengths[fidx]*100
-            delay = accum_delay//70
-            accum_delay -= delay*70
-            gif_fp.write(struct.pack("<BB", 0x21, 0xF9)) # AEB identifier: GCE
-            gif_fp.write(struct.pack("<BBHB", 4, 0b00000000, delay, 0)) # GCE data
-            gif_fp.write(struct.pack("<B", 0)) # end of AEB
 
-            # Image Descriptor
-            gif_fp.write(struct.pack("<B", 0x2C))
-            gif_fp.write(struct.pack("<HH", 0, 0)) # Image Left and Top Position
-            gif_fp.write(struct.pack("<HH", 320, 120)) # Image Width and Height
-            gif_fp.write(struct.pack("<B", 0b10000111)) # flags
+def haf2gif(haf_fname, haf_fp): # type: (str, IO[bytes]) -> None
+    print(f"Processing {haf_fname!r}")
 
-            # Local Color Table, Table Based Image Data
-            # (omiting the embedded 1-byte GIF Trailer here)
-            gif_fp.write(raw_frame_data[:-1])
+    gif_data = build_gif(haf_fp)
+    with open(get_gif_fname(haf_fname), "wb") as gif_fp:
+        gif_fp.write(gif_data)
 
-        # GIF Trailer
-        gif_fp.write(b"\x3B")
+
+def build_gif(haf_fp): # type: (IO[bytes]) -> bytearray
+    """Converts a whole HAF animation to a GIF, assembled in memory."""
+    return HafReader(haf_fp).build_gif()
 
 
 if __name__ == "__main__":
     main()
-